@@ -0,0 +1,112 @@
+"""Reading trades from and writing tax events to Parquet and Arrow files.
+
+Trades are read from a table with the columns
+
+    date          timestamp without time zone
+    type          string, the cointracking trade type
+    group         string or null
+    buy_coin      string or null
+    buy_amount    double or null
+    buy_value     double or null
+    sell_coin     string or null
+    sell_amount   double or null
+    sell_value    double or null
+    lineno        integer, optional
+
+where the values are in SEK, or in the currency given by --cointracking-usd
+or --cointracking-currency. The rows are expected in the order of the
+cointracking export, most recent trade first, unless a lineno column gives
+the line of each trade in the export.
+
+Files ending with .parquet are read and written as Parquet, files ending with
+.arrow or .feather in the Arrow IPC file format. pyarrow is only needed when
+such files are used.
+"""
+import os
+
+from taxdata import Trade, value_currency_of
+
+
+TRADE_COLUMNS = ['date', 'type', 'group', 'buy_coin', 'buy_amount', 'buy_value',
+                 'sell_coin', 'sell_amount', 'sell_value']
+
+_EXTENSIONS = ['.parquet', '.arrow', '.feather']
+
+
+def is_arrow_file(filename):
+    return os.path.splitext(filename)[1].lower() in _EXTENSIONS
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception("pyarrow is required to read and write Parquet and Arrow files, install it with pip install pyarrow")
+    return pyarrow
+
+
+def read_table(filename, columns=None):
+    _pyarrow()
+    if os.path.splitext(filename)[1].lower() == '.parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(filename, columns=columns)
+    import pyarrow.feather
+    return pyarrow.feather.read_table(filename, columns=columns)
+
+
+def write_table(table, filename):
+    _pyarrow()
+    if os.path.splitext(filename)[1].lower() == '.parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, filename)
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, filename)
+
+
+def read_trades(filename, value_currency, convert=True, source=None):
+    """Yield trades from a Parquet or Arrow file in file order, like taxdata.read_trades_csv()."""
+    pyarrow = _pyarrow()
+    table = read_table(filename)
+    missing = [column for column in TRADE_COLUMNS if column not in table.column_names]
+    if missing:
+        raise Exception(f"Trades file {filename} is missing the columns {', '.join(missing)}")
+    date_type = table.schema.field('date').type
+    if not pyarrow.types.is_timestamp(date_type) or date_type.tz is not None:
+        raise Exception(f"The date column of {filename} must be a timestamp without time zone")
+
+    # Whole columns are converted to python objects at once, no per field parsing is needed.
+    columns = [table.column(column).to_pylist() for column in TRADE_COLUMNS]
+    if 'lineno' in table.column_names:
+        linenos = table.column('lineno').to_pylist()
+    else:
+        linenos = range(1, table.num_rows + 1)
+    trades = (Trade(lineno, *fields, source=source) for (lineno, *fields) in zip(linenos, *columns))
+    value_currency = value_currency_of(value_currency)
+    if value_currency != 'SEK' and convert:
+        import fx
+        return fx.FxTable().convert_trades(trades, value_currency, 'SEK')
+    return trades
+
+
+def write_tax_events(tax_events, filename):
+    pyarrow = _pyarrow()
+    table = pyarrow.table({
+        'name': pyarrow.array([x.name for x in tax_events], pyarrow.string()),
+        'amount': pyarrow.array([x.amount for x in tax_events], pyarrow.float64()),
+        'income': pyarrow.array([x.income for x in tax_events], pyarrow.float64()),
+        'cost': pyarrow.array([x.cost for x in tax_events], pyarrow.float64()),
+    })
+    write_table(table, filename)
+
+
+def write_coin_balances(coin_states, filename):
+    """Write a {symbol: (amount, cost_basis)} dict of coin states, sorted by symbol."""
+    pyarrow = _pyarrow()
+    symbols = sorted(coin_states)
+    table = pyarrow.table({
+        'symbol': pyarrow.array(symbols, pyarrow.string()),
+        'amount': pyarrow.array([coin_states[symbol][0] for symbol in symbols], pyarrow.float64()),
+        'cost_basis': pyarrow.array([coin_states[symbol][1] for symbol in symbols], pyarrow.float64()),
+    })
+    write_table(table, filename)
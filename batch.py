@@ -0,0 +1,194 @@
+"""Generate reports for several portfolios and tax years from a manifest.
+
+The manifest is a json file of the form
+
+    {
+        "jobs": [
+            {
+                "trades": "data/client1/trades.csv",
+                "personal_details": "data/client1/personal_details.json",
+                "years": [2018, 2019],
+                "out": "out/client1",
+                "options": ["--simplified-k4", "--format", "pdf"]
+            }
+        ]
+    }
+
+where options are given as to report.py, except the profiling options, and
+trades can also be a list of files. All years of a job are computed in a
+single pass over its trades, or looked up in the result cache, and the
+report and any export of each year are written to a subfolder of out named
+by the year. Jobs are run in parallel.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from taxdata import PersonalDetails
+import arrowio
+import report
+import tax
+
+
+def job_options(job, year):
+    trades = job["trades"] if isinstance(job["trades"], list) else [job["trades"]]
+    argv = [str(year), '--trades', *trades, '--out', job["out"]]
+    if "personal_details" in job:
+        argv.extend(['--personal-details', job["personal_details"]])
+    if "stocks" in job:
+        argv.extend(['--stocks', job["stocks"]])
+    argv.extend(job.get("options", []))
+    # Invalid options fail the job instead of exiting the whole batch.
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            opts = report.build_parser().parse_args(argv)
+    except SystemExit:
+        raise Exception(stderr.getvalue().strip().splitlines()[-1])
+    if opts.profile or opts.profile_trace or opts.profile_stats:
+        raise Exception("Profiling is not supported by batch.py, run report.py with --profile instead")
+    if opts.snapshots and opts.engine != 'serial':
+        raise Exception("--snapshots is only supported by the serial engine")
+    return opts
+
+
+def compute_years(opts, trades, years, snapshots, coin_report_filenames):
+    """Return {year: (tax_events, coin_states)} of years computed with the engine selected in opts or None if the computation failed."""
+    exclude_groups = opts.exclude_groups if opts.exclude_groups else []
+    coin_states = {}
+    if opts.engine == 'columnar':
+        import costbasis
+        try:
+            table = costbasis.TradeTable.from_trades(trades)
+        except Exception as e:
+            print(e)
+            return None
+        tax_events_per_year = {}
+        for year in years:
+            year_coin_states = []
+            tax_events = costbasis.compute_tax(table, datetime(year=year, month=1, day=1, hour=0, minute=0),
+                                               datetime(year=year, month=12, day=31, hour=23, minute=59),
+                                               opts.max_overdraft, exclude_groups=exclude_groups,
+                                               coin_report_filename=coin_report_filenames.get(year),
+                                               jobs=opts.jobs, coin_states=year_coin_states)
+            if tax_events is None:
+                return None
+            tax_events_per_year[year] = tax_events
+            coin_states[year] = year_coin_states[0]
+    else:
+        tax_events_per_year = tax.compute_tax_per_year(trades, years, opts.max_overdraft,
+                                                       exclude_groups=exclude_groups,
+                                                       coin_report_filenames=coin_report_filenames,
+                                                       snapshots=snapshots, coin_states=coin_states)
+        if tax_events_per_year is None:
+            return None
+    return {year: (tax_events_per_year[year], coin_states[year]) for year in years}
+
+
+def run_job(job):
+    """Run a job from the manifest, returns True if all its reports were generated."""
+    years = sorted(job["years"])
+    opts = job_options(job, years[0])
+    if not os.path.isdir(opts.out):
+        os.makedirs(opts.out)
+    for year in years:
+        os.makedirs(os.path.join(opts.out, str(year)), exist_ok=True)
+    coin_report_filenames = {year: os.path.join(opts.out, str(year), "coin_report.csv") for year in years} if opts.coin_report else {}
+
+    with open(os.path.join(opts.out, "batch.log"), "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        cache = None
+        results = {}
+        try:
+            personal_details = PersonalDetails.read_from(opts.personal_details)
+            stock_tax_events = report.read_stock_tax_events(opts)
+            if not opts.no_cache:
+                from resultcache import ResultCache
+                cache = ResultCache(opts.cache_folder, int(opts.cache_size_mb * 1e6))
+                cache_keys = {year: report.result_cache_key(cache, opts, year) for year in years}
+                for year in years:
+                    cached = cache.load(cache_keys[year])
+                    if cached is not None:
+                        results[year] = cached
+            missing_years = [year for year in years if year not in results]
+            if missing_years:
+                fingerprints = []
+                trades = report.read_trades(opts, fingerprints)
+        except Exception as e:
+            print(e)
+            print(f"Aborting tax computation.")
+            return False
+
+        for year in years:
+            if year in results and opts.coin_report:
+                tax.write_coin_report(tax.coins_from_states(results[year][1], opts.max_overdraft),
+                                      coin_report_filenames[year])
+
+        if missing_years:
+            snapshots = None
+            if opts.snapshots:
+                if fingerprints[0] is None:
+                    print("Snapshots are only used for csv-files read with the trade cache.")
+                else:
+                    from snapshots import CostBasisSnapshots
+                    snapshots = CostBasisSnapshots(opts.snapshots).for_trades(fingerprints[0])
+            computed = compute_years(opts, trades, missing_years, snapshots, coin_report_filenames)
+            if computed is None:
+                print(f"Aborting tax computation.")
+                return False
+            results.update(computed)
+            if cache:
+                for year in missing_years:
+                    try:
+                        cache.save(cache_keys[year], *computed[year])
+                    except OSError as e:
+                        print(f"Could not cache the computed tax: {e}")
+
+        for year in years:
+            print(f"Tax year {year}")
+            year_out = os.path.join(opts.out, str(year))
+            (tax_events, coin_states) = results[year]
+            if opts.export:
+                try:
+                    arrowio.write_tax_events(tax_events, os.path.join(year_out, f"tax_events.{opts.export}"))
+                    arrowio.write_coin_balances(coin_states, os.path.join(year_out, f"coin_balances.{opts.export}"))
+                except Exception as e:
+                    print(e)
+                    return False
+            report.generate_report(job_options(job, year), year, personal_details,
+                                   tax_events, stock_tax_events, year_out)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate reports for several portfolios and tax years')
+    parser.add_argument('manifest', help='Json file listing the jobs to run')
+    parser.add_argument('--jobs', type=int, help='Number of jobs to run in parallel, defaults to the number of cpus')
+    opts = parser.parse_args(argv)
+
+    with open(opts.manifest, encoding="utf-8-sig") as f:
+        jobs = json.load(f)["jobs"]
+
+    failed = False
+    with ProcessPoolExecutor(max_workers=opts.jobs) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for (job, future) in zip(jobs, futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"{job['out']}: {e}")
+                ok = False
+            else:
+                print(f"{job['out']}: {'done' if ok else 'failed, see batch.log'}")
+            failed = failed or not ok
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+"""Benchmarks for the stages of report generation.
+
+Synthetic trade histories in the cointracking csv format can be generated with
+
+    python benchmark.py generate bench/trades.csv --rows 100000 --coins 50
+
+and the stages of report.py timed with
+
+    python benchmark.py run --rows 100000 --output results.json
+
+The cold start of an sru report can be checked against a time budget with
+
+    python benchmark.py startup --budget-ms 300
+
+Each stage is run once for timing and once with tracemalloc for its peak
+memory use. Results are written as json and can be compared against an
+earlier run with --compare.
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from taxdata import PersonalDetails, TaxEvent, Trades, read_usdsek_rates, usd_to_sek
+import tax
+
+
+DEFAULT_MIX = "Trade=70,Mining=10,Gift/Tip=5,Spend=15"
+
+# Cointracking uses non-breaking spaces in the value column names.
+CSV_HEADER = ["Type", "Buy", "Cur.", "Value\u00a0in\u00a0BTC", "Value\u00a0in\u00a0USD", "Value\u00a0in\u00a0SEK",
+              "Sell", "Cur.", "Value\u00a0in\u00a0BTC", "Value\u00a0in\u00a0USD", "Value\u00a0in\u00a0SEK",
+              "Spread", "Exchange", "Group", "Date"]
+
+
+def parse_mix(mix):
+    """Parse a trade type mix of the form "Trade=70,Mining=10" into (types, weights)."""
+    types = []
+    weights = []
+    for item in mix.split(","):
+        (trade_type, weight) = item.split("=")
+        if trade_type not in ["Trade", "Mining", "Gift/Tip", "Spend"]:
+            raise Exception(f"Unsupported trade type {trade_type}")
+        types.append(trade_type)
+        weights.append(float(weight))
+    return (types, weights)
+
+
+def generate_trades(filename, rows, coins=20, mix=DEFAULT_MIX, value_in_usd=False,
+                    from_year=2017, to_year=2019, seed=1):
+    """Write a synthetic trade history in the cointracking csv format.
+
+    The trades never sell more of a coin than has been bought, are spread
+    evenly over the years from_year to to_year and are written in reverse
+    chronological order like cointracking does.
+    """
+    rng = random.Random(seed)
+    (types, weights) = parse_mix(mix)
+    symbols = [f"C{index:03d}" for index in range(coins)]
+    holdings = {symbol: 0.0 for symbol in symbols}
+    prices = {symbol: rng.uniform(1.0, 10000.0) for symbol in symbols}
+    usdsek = read_usdsek_rates() if value_in_usd else None
+
+    start = datetime.datetime(year=from_year, month=1, day=1)
+    minutes = int((datetime.datetime(year=to_year + 1, month=1, day=1) - start).total_seconds() // 60)
+    offsets = sorted(rng.randrange(minutes) for _ in range(rows))
+
+    def values(value_sek, date):
+        if usdsek:
+            return ("-", repr(value_sek / usd_to_sek(usdsek, date)), repr(value_sek))
+        return ("-", "-", repr(value_sek))
+
+    lines = []
+    for offset in offsets:
+        date = start + datetime.timedelta(minutes=offset)
+        symbol = rng.choice(symbols)
+        prices[symbol] *= rng.uniform(0.98, 1.02)
+        price = prices[symbol]
+        group = rng.choice(["-", "-", "bot", "manual"])
+        trade_type = rng.choices(types, weights)[0]
+        if trade_type in ["Trade", "Spend"] and holdings[symbol] <= 1e-6:
+            trade_type = "Trade"
+            sell_amount = 0.0
+        else:
+            sell_amount = holdings[symbol] * rng.uniform(0.05, 0.5)
+        buy_amount = rng.uniform(0.01, 10.0)
+
+        if trade_type == "Trade" and sell_amount == 0.0:
+            # Buy with SEK
+            value = buy_amount * price
+            line = ["Trade", repr(buy_amount), symbol, *values(value, date), repr(value), "SEK", *values(value, date)]
+            holdings[symbol] += buy_amount
+        elif trade_type == "Trade" and rng.random() < 0.5:
+            # Sell for SEK
+            value = sell_amount * price
+            line = ["Trade", repr(value), "SEK", *values(value, date), repr(sell_amount), symbol, *values(value, date)]
+            holdings[symbol] -= sell_amount
+        elif trade_type == "Trade":
+            # Trade for another coin
+            other = rng.choice(symbols)
+            value = sell_amount * price
+            other_amount = value / prices[other]
+            line = ["Trade", repr(other_amount), other, *values(value, date), repr(sell_amount), symbol, *values(value, date)]
+            holdings[symbol] -= sell_amount
+            holdings[other] += other_amount
+        elif trade_type == "Spend":
+            value = sell_amount * price
+            line = ["Spend", "-", "-", "-", "-", "-", repr(sell_amount), symbol, *values(value, date)]
+            holdings[symbol] -= sell_amount
+        elif trade_type == "Mining":
+            value = buy_amount * price
+            line = ["Mining", repr(buy_amount), symbol, *values(value, date), "-", "-", "-", "-", "-"]
+            holdings[symbol] += buy_amount
+        else:
+            line = ["Gift/Tip", repr(buy_amount), symbol, "-", "-", "-", "-", "-", "-", "-", "-"]
+            holdings[symbol] += buy_amount
+        line.extend(["", "Exchange", group, date.strftime("%d.%m.%Y %H:%M")])
+        lines.append(line)
+
+    with open(filename, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writer.writerow(CSV_HEADER)
+        for line in reversed(lines):
+            writer.writerow(line)
+
+
+class Stage:
+    def __init__(self, name, seconds, items, peak_bytes):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.peak_bytes = peak_bytes
+
+    def to_json(self):
+        return {"seconds": self.seconds,
+                "items": self.items,
+                "items_per_second": self.items / self.seconds if self.seconds > 0 else None,
+                "peak_bytes": self.peak_bytes}
+
+
+def run_stages(trades_filename, year, value_in_usd, pdf, out, state=None):
+    """Run the stages of report.py, returns a list of (name, function) where
+    each function runs the stage and returns the number of items it handled.
+    The results of the stages are kept in the dict state."""
+    personal_details = PersonalDetails("Benchmark", "19700101-0000", "00000", "Benchmark")
+    from_date = datetime.datetime(year=year, month=1, day=1, hour=0, minute=0)
+    to_date = datetime.datetime(year=year, month=12, day=31, hour=23, minute=59)
+    if state is None:
+        state = {}
+
+    def read():
+        state["trades"] = Trades.read_from(trades_filename, value_in_usd)
+        return len(state["trades"].trades)
+
+    def compute_tax():
+        with contextlib.redirect_stdout(io.StringIO()):
+            state["tax_events"] = tax.compute_tax(state["trades"], from_date, to_date, 1e-9)
+        if state["tax_events"] is None:
+            raise Exception("Tax computation failed")
+        return len(state["trades"].trades)
+
+    def aggregate():
+        state["aggregated"] = tax.aggregate_per_coin(state["tax_events"])
+        return len(state["tax_events"])
+
+    def rounding():
+        tax_events = tax.convert_to_integer_amounts_with_prefix(state["aggregated"], 0.5)
+        state["rounded"] = tax.convert_sek_to_integer_amounts(tax_events)
+        return len(state["rounded"])
+
+    def pages():
+        # The unaggregated events give the largest number of pages.
+        tax_events = tax.convert_sek_to_integer_amounts(tax.convert_to_integer_amounts(
+            [TaxEvent(x.amount, x.name, x.income, x.cost) for x in state["tax_events"]]))
+        state["pages"] = tax.generate_k4_pages(year, personal_details, tax_events)
+        return len(state["pages"])
+
+    def sru():
+        tax.generate_k4_sru(state["pages"], personal_details, out)
+        return len(state["pages"])
+
+    def pdf_output():
+        tax.generate_k4_pdf(state["pages"], out)
+        return len(state["pages"])
+
+    stages = [("read", read), ("compute_tax", compute_tax), ("aggregate_per_coin", aggregate),
+              ("rounding", rounding), ("generate_k4_pages", pages), ("sru", sru)]
+    if pdf:
+        stages.append(("pdf", pdf_output))
+    return stages
+
+
+def benchmark(trades_filename, year, value_in_usd=False, pdf=False):
+    """Time and measure the peak memory of each stage, returns a list of Stage."""
+    results = []
+    with tempfile.TemporaryDirectory() as out:
+        for (name, function) in run_stages(trades_filename, year, value_in_usd, pdf, out):
+            start = time.perf_counter()
+            items = function()
+            results.append(Stage(name, time.perf_counter() - start, items, None))
+
+        # Separate pass for memory since tracing slows down the stages.
+        for (stage, (name, function)) in zip(results, run_stages(trades_filename, year, value_in_usd, pdf, out)):
+            tracemalloc.start()
+            function()
+            stage.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return results
+
+
+def check_pdf(trades_filename, year, value_in_usd=False):
+    """Return the numbers of the pdf pages written by the pdf stage which differ
+    from the page merged onto a template parsed from its file for it alone."""
+    import pdfrw
+
+    state = {}
+    differing = []
+    with tempfile.TemporaryDirectory() as out:
+        for (_, function) in run_stages(trades_filename, year, value_in_usd, True, out, state):
+            function()
+        for page in state["pages"]:
+            expected = page.generate_pdf_data(page.generate_pdf_overlays(), pdfrw.PdfReader(f"docs/K4-template-{year}.pdf"))
+            with open(os.path.join(out, page.pdf_filename()), 'rb') as f:
+                if f.read() != expected:
+                    differing.append(page._page_number)
+    return differing
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_stages = baseline["stages"] if baseline else {}
+    print(f"{'Stage'.ljust(20)}{'Seconds'.rjust(10)}{'Items/s'.rjust(14)}{'Peak MB'.rjust(10)}"
+          f"{'vs baseline'.rjust(13) if baseline else ''}")
+    for stage in results:
+        items_per_second = f"{stage.items / stage.seconds:.0f}" if stage.seconds > 0 else "-"
+        line = (f"{stage.name.ljust(20)}{stage.seconds:10.3f}{items_per_second.rjust(14)}"
+                f"{stage.peak_bytes / 1e6:10.1f}")
+        if stage.name in baseline_stages and baseline_stages[stage.name]["seconds"]:
+            line += f"{stage.seconds / baseline_stages[stage.name]['seconds']:12.2f}x"
+        print(line)
+
+
+# Modules which only some code paths need and which should not be imported
+# when generating an sru report from SEK values.
+HEAVY_MODULES = ["dateutil", "reportlab", "pdfrw", "costbasis", "snapshots", "tempfile", "pickle", "pyarrow"]
+
+
+def imported_modules(argv, cwd):
+    """Run python with argv under -X importtime, returns {module: cumulative microseconds}."""
+    result = subprocess.run([sys.executable, "-X", "importtime", *argv], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        (_, cumulative, name) = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def startup(runs=10, budget_ms=None):
+    """Time the cold start of report.py generating an sru report for a tiny trade history.
+
+    Returns True if the fastest run is within budget_ms and none of the
+    HEAVY_MODULES were imported.
+    """
+    report_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "report.py")
+    with tempfile.TemporaryDirectory() as tmp:
+        trades_filename = os.path.join(tmp, "trades.csv")
+        generate_trades(trades_filename, 10, coins=2, from_year=2019, to_year=2019)
+        personal_details_filename = os.path.join(tmp, "personal_details.json")
+        with open(personal_details_filename, "w", encoding="utf-8") as f:
+            json.dump({"namn": "Benchmark", "personnummer": "19700101-0000", "postnummer": "00000", "postort": "Benchmark"}, f)
+        argv = [report_filename, "2019", "--trades", trades_filename, "--out", os.path.join(tmp, "out"),
+                "--personal-details", personal_details_filename, "--stocks", os.path.join(tmp, "stocks.json")]
+
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *argv], cwd=tmp, stdout=subprocess.DEVNULL, check=True)
+            timings.append((time.perf_counter() - start) * 1000)
+        modules = imported_modules(argv, tmp)
+
+    heavy = sorted(name for name in modules if name.split(".")[0] in HEAVY_MODULES)
+    print(f"Startup: {min(timings):.1f} ms fastest, {sorted(timings)[len(timings) // 2]:.1f} ms median of {runs} runs")
+    print("Slowest imports:")
+    top_level = {name: cumulative for (name, cumulative) in modules.items() if "." not in name}
+    for (name, cumulative) in sorted(top_level.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {name.ljust(24)}{cumulative / 1000:8.1f} ms")
+
+    ok = True
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+        ok = False
+    if budget_ms is not None and min(timings) > budget_ms:
+        print(f"Startup exceeds the budget of {budget_ms} ms")
+        ok = False
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for cryptotaxsweden')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_generate_arguments(subparser):
+        subparser.add_argument('--rows', type=int, default=100000, help='Number of trades to generate')
+        subparser.add_argument('--coins', type=int, default=20, help='Number of different coins to trade')
+        subparser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of the trade types to generate')
+        subparser.add_argument('--usd', action='store_true', help='Generate values in USD as with --cointracking-usd')
+        subparser.add_argument('--from-year', type=int, default=2017, help='First year of trades')
+        subparser.add_argument('--to-year', type=int, default=2019, help='Last year of trades')
+        subparser.add_argument('--seed', type=int, default=1, help='Seed for the random generator')
+
+    generate = subparsers.add_parser('generate', help='Generate a synthetic cointracking csv-file')
+    generate.add_argument('filename', help='The csv-file to write')
+    add_generate_arguments(generate)
+
+    run = subparsers.add_parser('run', help='Time the stages of report generation')
+    run.add_argument('--trades', help='Benchmark with this csv-file instead of a generated one')
+    add_generate_arguments(run)
+    run.add_argument('--year', type=int, help='The tax year to report, defaults to the last year of trades')
+    run.add_argument('--pdf', action='store_true', help='Include pdf generation')
+    run.add_argument('--output', help='Write the results as json to this file')
+    run.add_argument('--compare', help='Compare against results from an earlier run')
+
+    check_pdf_parser = subparsers.add_parser('check-pdf', help='Check that the pdf pages equal pages rendered on their own')
+    check_pdf_parser.add_argument('--trades', help='Check with this csv-file instead of a generated one')
+    add_generate_arguments(check_pdf_parser)
+    check_pdf_parser.add_argument('--year', type=int, help='The tax year to report, defaults to the last year of trades')
+
+    startup_parser = subparsers.add_parser('startup', help='Time the cold start of an sru report')
+    startup_parser.add_argument('--runs', type=int, default=10, help='Number of times to start report.py')
+    startup_parser.add_argument('--budget-ms', type=float, help='Fail if the fastest start takes longer than this')
+
+    opts = parser.parse_args(argv)
+
+    if opts.command == 'startup':
+        if not startup(opts.runs, opts.budget_ms):
+            sys.exit(1)
+        return
+
+    if opts.command == 'generate':
+        generate_trades(opts.filename, opts.rows, opts.coins, opts.mix, opts.usd, opts.from_year, opts.to_year, opts.seed)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trades_filename = opts.trades
+        if not trades_filename:
+            trades_filename = os.path.join(tmp, "trades.csv")
+            generate_trades(trades_filename, opts.rows, opts.coins, opts.mix, opts.usd, opts.from_year, opts.to_year, opts.seed)
+        year = opts.year if opts.year else opts.to_year
+        if opts.command == 'check-pdf':
+            differing = check_pdf(trades_filename, year, opts.usd)
+            if differing:
+                print(f"Pages differing from pages rendered on their own: {', '.join(map(str, differing))}")
+                sys.exit(1)
+            print("All pdf pages equal the pages rendered on their own")
+            return
+        results = benchmark(trades_filename, year, opts.usd, opts.pdf)
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if opts.output:
+        with open(opts.output, "w", encoding="utf-8") as f:
+            json.dump({"version": git_version(),
+                       "python": platform.python_version(),
+                       "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "parameters": {"trades": opts.trades, "rows": opts.rows, "coins": opts.coins, "mix": opts.mix,
+                                      "usd": opts.usd, "from_year": opts.from_year, "to_year": opts.to_year,
+                                      "seed": opts.seed, "year": year, "pdf": opts.pdf},
+                       "stages": {stage.name: stage.to_json() for stage in results}}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+"""Column oriented average cost basis engine.
+
+The trades are stored column wise in a TradeTable and split into one stream
+of buy and sell operations per coin. Since the price of every operation is
+given by the trade itself the coins are independent of each other and the
+running amount and cost basis of each coin is computed in a loop over its own
+operations, without any per trade dispatch on the trade type or lookups of
+Coin objects.
+
+The loop is still plain Python and in a single process no faster than the
+serial engine in tax.py. What the split gives is coins that can be computed
+in parallel worker processes, recomputed alone for what-if runs and
+replayed from checkpoints for point in time holdings.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+from taxdata import TaxEvent, trade_location
+import tax
+
+
+TYPE_OTHER = 0
+TYPE_TRADE = 1
+TYPE_MINING = 2
+TYPE_GIFT = 3
+TYPE_SPEND = 4
+
+_TYPE_CODES = {'Trade': TYPE_TRADE, 'Mining': TYPE_MINING, 'Gift/Tip': TYPE_GIFT, 'Spend': TYPE_SPEND}
+
+_MISSING = float('nan')
+
+
+class TradeTable:
+    """Trades in chronological order stored as one array per field.
+
+    Coins are stored as indices into coins and missing amounts and values
+    as NaN.
+    """
+
+    def __init__(self):
+        self.lineno = array('q')
+        self.sources = []
+        self.dates = []
+        self.types = array('b')
+        self.groups = []
+        self.buy_coin = array('i')
+        self.buy_amount = array('d')
+        self.buy_value = array('d')
+        self.sell_coin = array('i')
+        self.sell_amount = array('d')
+        self.sell_value = array('d')
+        self.coins = []
+        self._coin_indices = {}
+        self._group_rows = None
+
+    def __len__(self):
+        return len(self.dates)
+
+    def coin_symbol(self, index):
+        """Return the coin of a coin index, None for the -1 of a trade without the coin."""
+        return self.coins[index] if index >= 0 else None
+
+    def coin_index(self, coin):
+        if coin is None:
+            return -1
+        index = self._coin_indices.get(coin)
+        if index is None:
+            index = self._coin_indices[coin] = len(self.coins)
+            self.coins.append(coin)
+        return index
+
+    def group_rows(self, group):
+        """Return the rows of the trades in group in chronological order."""
+        if self._group_rows is None:
+            self._group_rows = {}
+            for (row, row_group) in enumerate(self.groups):
+                self._group_rows.setdefault(row_group, array('q')).append(row)
+        return self._group_rows.get(group, array('q'))
+
+    def append(self, trade):
+        self._group_rows = None
+        self.lineno.append(trade.lineno)
+        self.sources.append(trade.source)
+        self.dates.append(trade.date)
+        self.types.append(_TYPE_CODES.get(trade.type, TYPE_OTHER))
+        self.groups.append(trade.group)
+        self.buy_coin.append(self.coin_index(trade.buy_coin))
+        self.buy_amount.append(_MISSING if trade.buy_amount is None else trade.buy_amount)
+        self.buy_value.append(_MISSING if trade.buy_value is None else trade.buy_value)
+        self.sell_coin.append(self.coin_index(trade.sell_coin))
+        self.sell_amount.append(_MISSING if trade.sell_amount is None else trade.sell_amount)
+        self.sell_value.append(_MISSING if trade.sell_value is None else trade.sell_value)
+
+    @staticmethod
+    def from_trades(trades):
+        """Build a table from trades given in chronological order."""
+        table = TradeTable()
+        for trade in trades:
+            table.append(trade)
+        return table
+
+
+class CoinOperations:
+    """The buy and sell operations of a single coin in chronological order.
+
+    Each operation is a (row, is_buy, amount, price) tuple.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.operations = []
+
+
+def split_per_coin(table, rows, native_currency='SEK'):
+    """Split the given rows of table into CoinOperations per coin index.
+
+    Like tax.apply_trade() a missing coin is a coin of its own, with the
+    index -1 and the symbol None, so that selling it fails unless it has
+    been bought.
+    """
+    native_index = table._coin_indices.get(native_currency, -2)
+    # The operations of the missing coin are last.
+    operations = [[] for _ in range(len(table.coins) + 1)]
+    missing_index = len(table.coins)
+
+    types = table.types
+    buy_coin = table.buy_coin
+    buy_amount = table.buy_amount
+    buy_value = table.buy_value
+    sell_coin = table.sell_coin
+    sell_amount = table.sell_amount
+    sell_value = table.sell_value
+    for row in rows:
+        trade_type = types[row]
+        bought = buy_coin[row]
+        sold = sell_coin[row]
+        if bought < 0:
+            bought = missing_index
+        if sold < 0:
+            sold = missing_index
+        if trade_type == TYPE_TRADE:
+            if sold == native_index:
+                value_sek = sell_value[row]
+            else:
+                value_sek = buy_value[row]
+            if bought != native_index:
+                operations[bought].append((row, True, buy_amount[row], value_sek))
+            if sold != native_index:
+                operations[sold].append((row, False, sell_amount[row], value_sek))
+        elif trade_type == TYPE_MINING:
+            if bought != native_index:
+                operations[bought].append((row, True, buy_amount[row], buy_value[row]))
+        elif trade_type == TYPE_GIFT:
+            if bought != native_index:
+                operations[bought].append((row, True, buy_amount[row], 0.0))
+        elif trade_type == TYPE_SPEND:
+            if sold != native_index:
+                operations[sold].append((row, False, sell_amount[row], sell_value[row]))
+
+    per_coin = {}
+    for (coin_index, coin_operations) in enumerate(operations):
+        if coin_operations:
+            if coin_index == missing_index:
+                coin_index = -1
+            per_coin[coin_index] = CoinOperations(table.coin_symbol(coin_index))
+            per_coin[coin_index].operations = coin_operations
+    return per_coin
+
+
+def replay_coin(coin_ops, start, end, amount, cost_basis, max_overdraft, events=None, first_event_row=0):
+    """Apply the operations start to end of a coin to its amount and cost basis.
+
+    Returns (amount, cost_basis, error) where error is None or (index, row,
+    message) for the first operation which failed. The operations before
+    start must have succeeded. If events is a list, (row, TaxEvent) of the
+    sales from first_event_row are appended to it.
+    """
+    symbol = coin_ops.symbol
+    bought = start > 0
+    for (index, (row, is_buy, qty, price)) in enumerate(coin_ops.operations[start:end], start):
+        if qty != qty or price != price:
+            return (amount, cost_basis, (index, row, "Missing amount or value"))
+        if is_buy:
+            bought = True
+            new_amount = amount + qty
+            if new_amount == 0.0:
+                return (amount, cost_basis, (index, row, "float division by zero"))
+            cost_basis = (cost_basis * amount + price) / new_amount
+            amount = new_amount
+        else:
+            if not bought:
+                return (amount, cost_basis, (index, row, f"Selling currency {symbol} which has not been bought yet"))
+            amount_left = amount - qty
+            if amount_left < -max_overdraft:
+                return (amount, cost_basis, (index, row, f"Not enough coins available for {symbol}, {amount} < {qty}."))
+            if events is not None and row >= first_event_row:
+                events.append((row, TaxEvent(qty, symbol, price, cost_basis * qty)))
+            amount = amount_left if amount_left > 0.0 else 0.0
+    return (amount, cost_basis, None)
+
+
+def run_coin(coin_ops, first_event_row, max_overdraft):
+    """Compute the running amount and cost basis of a coin.
+
+    Returns (amount, cost_basis, events, error) where events is a list of
+    (row, TaxEvent) for the sales from first_event_row and error is None or
+    (row, message) for the first operation which failed.
+    """
+    events = []
+    (amount, cost_basis, error) = replay_coin(coin_ops, 0, len(coin_ops.operations), 0.0, 0.0, max_overdraft,
+                                              events, first_event_row)
+    return (amount, cost_basis, events, error[1:] if error is not None else None)
+
+
+def select_rows(table, to_date, exclude_groups=[]):
+    end = bisect_right(table.dates, to_date)
+    if not exclude_groups:
+        return range(end)
+    exclude_groups = set(exclude_groups)
+    groups = table.groups
+    return [row for row in range(end) if groups[row] not in exclude_groups]
+
+
+def merge_coin_results(table, results, max_overdraft):
+    """Merge (coin_index, run_coin() result) pairs into chronological tax events and Coin states.
+
+    Returns (tax_events, coins), raises an exception for the first failed row.
+    """
+    errors = [result[3] for (_, result) in results if result[3] is not None]
+    if errors:
+        (row, message) = min(errors)
+        raise Exception(f"Exception encountered at {trade_location(table.lineno[row], table.sources[row])}: {message}")
+
+    row_events = []
+    coins = {}
+    for (coin_index, (amount, cost_basis, events, _)) in results:
+        row_events.extend(events)
+        coin = tax.Coin(table.coin_symbol(coin_index), max_overdraft)
+        coin.amount = amount
+        coin.cost_basis = cost_basis
+        coins[coin.symbol] = coin
+    row_events.sort(key=lambda row_event: row_event[0])
+    return ([tax_event for (_, tax_event) in row_events], coins)
+
+
+def run_coins(coin_operations, first_event_row, max_overdraft):
+    """run_coin() for a list of (coin_index, CoinOperations), used as a unit of work for worker processes."""
+    return [(coin_index, run_coin(coin_ops, first_event_row, max_overdraft))
+            for (coin_index, coin_ops) in coin_operations]
+
+
+def partition_coins(operations, partitions):
+    """Split operations into at most partitions lists with about the same number of operations each."""
+    bins = [(0, index, []) for index in range(partitions)]
+    for (coin_index, coin_ops) in sorted(operations.items(), key=lambda item: -len(item[1].operations)):
+        (size, index, coins) = min(bins)
+        coins.append((coin_index, coin_ops))
+        bins[index] = (size + len(coin_ops.operations), index, coins)
+    return [coins for (_, _, coins) in bins if coins]
+
+
+def compute_tax(table, from_date, to_date, max_overdraft, native_currency='SEK', exclude_groups=[], coin_report_filename=None,
+                jobs=1, coin_states=None):
+    """Column oriented version of tax.compute_tax() for a TradeTable.
+
+    With jobs > 1 the coins are computed in that many worker processes.
+    """
+    operations = split_per_coin(table, select_rows(table, to_date, exclude_groups), native_currency)
+    first_event_row = bisect_left(table.dates, from_date)
+    if jobs > 1 and len(operations) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from itertools import repeat
+
+        # A few partitions per worker evens out coins of very different size.
+        partitions = partition_coins(operations, jobs * 4)
+        results = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for partition_results in executor.map(run_coins, partitions, repeat(first_event_row), repeat(max_overdraft)):
+                results.extend(partition_results)
+    else:
+        results = run_coins(operations.items(), first_event_row, max_overdraft)
+
+    try:
+        (tax_events, coins) = merge_coin_results(table, results, max_overdraft)
+    except Exception as e:
+        print(e)
+        return None
+
+    if coin_report_filename:
+        tax.write_coin_report(coins, coin_report_filename)
+    if coin_states is not None:
+        coin_states.append({symbol: (coin.amount, coin.cost_basis) for (symbol, coin) in coins.items()})
+
+    return tax_events
+
+
+class ExcludeGroupsAnalysis:
+    """Computes the tax of a period for different sets of excluded groups.
+
+    The trades are split per coin once and every coin is computed without
+    any excluded groups. For a set of excluded groups only the coins traded
+    in those groups are computed again and the results of the other coins
+    are reused, as are the results of earlier sets which excluded the same
+    groups for a coin.
+    """
+
+    def __init__(self, table, from_date, to_date, max_overdraft, native_currency='SEK'):
+        self.table = table
+        self.max_overdraft = max_overdraft
+        self._end = bisect_right(table.dates, to_date)
+        self._first_event_row = bisect_left(table.dates, from_date)
+        self._operations = split_per_coin(table, range(self._end), native_currency)
+        self._group_coins = {}
+        self._results = {}
+
+    def group_coins(self, group):
+        """Return the indices of the coins traded in group during or before the period."""
+        coins = self._group_coins.get(group)
+        if coins is None:
+            rows = self.table.group_rows(group)
+            coins = set()
+            for row in rows[:bisect_left(rows, self._end)]:
+                coins.add(self.table.buy_coin[row])
+                coins.add(self.table.sell_coin[row])
+            coins = self._group_coins[group] = frozenset(coins.intersection(self._operations))
+        return coins
+
+    def _coin_result(self, coin_index, excluded_groups):
+        key = (coin_index, excluded_groups)
+        result = self._results.get(key)
+        if result is None:
+            coin_ops = self._operations[coin_index]
+            if excluded_groups:
+                groups = self.table.groups
+                included = CoinOperations(coin_ops.symbol)
+                included.operations = [operation for operation in coin_ops.operations
+                                       if groups[operation[0]] not in excluded_groups]
+                coin_ops = included
+            result = self._results[key] = run_coin(coin_ops, self._first_event_row, self.max_overdraft)
+        return result
+
+    def compute_tax(self, exclude_groups=[], coin_states=None):
+        """Return the tax events of the period with exclude_groups excluded, or None if the computation failed.
+
+        The tax events are new objects which the caller is free to modify.
+        """
+        coin_excluded_groups = {}
+        for group in set(exclude_groups):
+            for coin_index in self.group_coins(group):
+                coin_excluded_groups.setdefault(coin_index, set()).add(group)
+        results = [(coin_index, self._coin_result(coin_index, frozenset(coin_excluded_groups.get(coin_index, ()))))
+                   for coin_index in self._operations]
+
+        try:
+            (tax_events, coins) = merge_coin_results(self.table, results, self.max_overdraft)
+        except Exception as e:
+            print(e)
+            return None
+
+        if coin_states is not None:
+            coin_states.append({symbol: (coin.amount, coin.cost_basis) for (symbol, coin) in coins.items()})
+        return [TaxEvent(x.amount, x.name, x.income, x.cost) for x in tax_events]
+
+
+class CoinCheckpoints:
+    """The operations of a coin with the amount and cost basis before every interval:th operation."""
+
+    def __init__(self, coin_ops, dates, max_overdraft, interval):
+        self.coin_ops = coin_ops
+        self.dates = dates
+        self.amounts = array('d')
+        self.cost_bases = array('d')
+        # (operation index, row, message) of the first failed operation.
+        self.error = None
+
+        amount = 0.0
+        cost_basis = 0.0
+        count = len(coin_ops.operations)
+        for start in range(0, count, interval):
+            self.amounts.append(amount)
+            self.cost_bases.append(cost_basis)
+            end = min(start + interval, count)
+            (amount, cost_basis, self.error) = replay_coin(coin_ops, start, end, amount, cost_basis, max_overdraft)
+            if self.error is not None:
+                break
+
+
+class HoldingsIndex:
+    """The amount and cost basis of each coin at any point in time.
+
+    The operations of each coin are run once, storing the running amount and
+    cost basis every interval operations. The state of a coin at a date is
+    then found with a binary search on the dates of its operations and a
+    replay of at most interval - 1 operations from the preceding checkpoint.
+    """
+
+    def __init__(self, table, max_overdraft, native_currency='SEK', exclude_groups=[], interval=64):
+        self.table = table
+        self.max_overdraft = max_overdraft
+        self.interval = interval
+        exclude_groups = set(exclude_groups)
+        if exclude_groups:
+            rows = [row for (row, group) in enumerate(table.groups) if group not in exclude_groups]
+        else:
+            rows = range(len(table))
+        self._coins = {}
+        for coin_ops in split_per_coin(table, rows, native_currency).values():
+            dates = [table.dates[operation[0]] for operation in coin_ops.operations]
+            self._coins[coin_ops.symbol] = CoinCheckpoints(coin_ops, dates, max_overdraft, interval)
+
+    def symbols(self):
+        # The missing coin has the symbol None.
+        return sorted(self._coins, key=str)
+
+    def holding(self, symbol, date):
+        """Return (amount, cost_basis) of symbol after all trades up to and including date.
+
+        Raises an exception if a trade of the coin up to date could not be applied.
+        """
+        checkpoints = self._coins.get(symbol)
+        if checkpoints is None:
+            return (0.0, 0.0)
+        count = bisect_right(checkpoints.dates, date)
+        if checkpoints.error is not None and count > checkpoints.error[0]:
+            (_, row, message) = checkpoints.error
+            raise Exception(f"Exception encountered at {trade_location(self.table.lineno[row], self.table.sources[row])}: {message}")
+        checkpoint = count // self.interval
+        if checkpoint == len(checkpoints.amounts):
+            # count is a multiple of the interval past the last checkpoint.
+            checkpoint -= 1
+        start = checkpoint * self.interval
+        (amount, cost_basis, _) = replay_coin(checkpoints.coin_ops, start, count, checkpoints.amounts[checkpoint],
+                                              checkpoints.cost_bases[checkpoint], self.max_overdraft)
+        return (amount, cost_basis)
+
+    def holdings(self, date):
+        """Return a {symbol: (amount, cost_basis)} dict of all coins at date in the order of symbols()."""
+        return {symbol: self.holding(symbol, date) for symbol in self.symbols()}
@@ -0,0 +1,99 @@
+"""Currency conversion with daily rates from data/rates.
+
+The rates of a currency pair are read from data/rates/<pair>.csv, e.g.
+data/rates/eursek.csv for the SEK price of one EUR, in the same format as
+data/rates/usdsek.csv. A pair without a rates file is converted with the
+inverse pair if available, otherwise through the base currency, e.g. EUR to
+SEK via eurusd.csv and usdsek.csv.
+
+Values are converted a column at a time, the rates of all dates of a column
+are looked up in a single as-of merge over the sorted dates.
+"""
+import os
+
+from taxdata import convert_trade_values, read_rates
+
+
+RATES_FOLDER = 'data/rates'
+
+
+def is_currency_code(currency):
+    return len(currency) == 3 and currency.isascii() and currency.isalpha()
+
+
+class FxTable:
+    """The rates files of a folder, each rates file is read once and reread when it has been modified."""
+
+    def __init__(self, folder=RATES_FOLDER, base_currency='USD'):
+        self.folder = folder
+        self.base_currency = base_currency.upper()
+        self._rates = {}
+
+    def _filename(self, from_currency, to_currency):
+        return os.path.join(self.folder, f"{from_currency.lower()}{to_currency.lower()}.csv")
+
+    def _pair_rates(self, from_currency, to_currency):
+        filename = self._filename(from_currency, to_currency)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_mtime, stat.st_size)
+        loaded = self._rates.get(filename)
+        if loaded is None or loaded[0] != key:
+            loaded = self._rates[filename] = (key, read_rates(filename))
+        return loaded[1]
+
+    def _leg(self, from_currency, to_currency):
+        # (filename, rates, inverse) for a single conversion or None.
+        for (pair, inverse) in [((from_currency, to_currency), False), ((to_currency, from_currency), True)]:
+            rates = self._pair_rates(*pair)
+            if rates is not None:
+                return (self._filename(*pair), rates, inverse)
+        return None
+
+    def path(self, from_currency, to_currency):
+        """Return the conversion from from_currency to to_currency as a list of (filename, rates, inverse) legs."""
+        from_currency = from_currency.upper()
+        to_currency = to_currency.upper()
+        for currency in [from_currency, to_currency]:
+            # The codes name the rates files.
+            if not is_currency_code(currency):
+                raise Exception(f"Invalid currency code {currency}, expected three letters such as EUR")
+        if from_currency == to_currency:
+            return []
+        leg = self._leg(from_currency, to_currency)
+        if leg is not None:
+            return [leg]
+        if self.base_currency not in [from_currency, to_currency]:
+            legs = [self._leg(from_currency, self.base_currency), self._leg(self.base_currency, to_currency)]
+            if None not in legs:
+                return legs
+        raise Exception(f"No rates for converting {from_currency} to {to_currency} in {self.folder}, "
+                        f"add {self._filename(from_currency, to_currency)}")
+
+    def rates_filenames(self, from_currency, to_currency):
+        """Return the rates files used to convert from_currency to to_currency."""
+        return [filename for (filename, _, _) in self.path(from_currency, to_currency)]
+
+    def rates_at(self, from_currency, to_currency, dates):
+        """Return the rates converting from_currency to to_currency at each of dates."""
+        converted = [1.0] * len(dates)
+        for (_, rates, inverse) in self.path(from_currency, to_currency):
+            leg_rates = rates.rates_at(dates)
+            if inverse:
+                converted = [rate / leg_rate for (rate, leg_rate) in zip(converted, leg_rates)]
+            else:
+                converted = [rate * leg_rate for (rate, leg_rate) in zip(converted, leg_rates)]
+        return converted
+
+    def convert(self, from_currency, to_currency, dates, values):
+        """Return the values given in from_currency at dates converted to to_currency, None values are kept."""
+        rates = self.rates_at(from_currency, to_currency, dates)
+        return [value * rate if value is not None else None for (value, rate) in zip(values, rates)]
+
+    def convert_trades(self, trades, from_currency, to_currency='SEK'):
+        """Yield trades with their buy and sell values converted from from_currency to to_currency."""
+        # Resolve the path up front so that missing rates are reported before any trade is read.
+        self.path(from_currency, to_currency)
+        return convert_trade_values(trades, lambda dates: self.rates_at(from_currency, to_currency, dates))
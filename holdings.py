@@ -0,0 +1,81 @@
+"""Print the amount and cost basis of coins at given dates.
+
+    python holdings.py --query 2019-06-30 BTC ETH --query "2018-03-01 12:00"
+
+prints the amount and cost basis of each coin of a query after all trades up
+to and including its date, or of all coins held if no coins are given. A date
+without a time means the end of that day. Without --query the queries are
+read from standard input, one line of a date, an optional time and coins at
+a time. The trades are run once and each query only replays a few trades of
+each coin from the nearest stored state.
+"""
+import argparse
+import datetime
+import sys
+
+import costbasis
+import report
+
+
+def parse_query(words):
+    """Return (date, symbols) of a query given as a date, an optional time and coins."""
+    # The date and time may be given as a single argument, e.g. "2018-03-01 12:00".
+    words = words[0].split() + words[1:]
+    date = datetime.datetime.strptime(words[0], "%Y-%m-%d")
+    symbols = words[1:]
+    if symbols and ':' in symbols[0]:
+        time = datetime.datetime.strptime(symbols[0], "%H:%M")
+        return (date.replace(hour=time.hour, minute=time.minute), symbols[1:])
+    return (date.replace(hour=23, minute=59), symbols)
+
+
+def print_holdings(index, words):
+    try:
+        (date, symbols) = parse_query(words)
+        if symbols:
+            holdings = [(symbol, index.holding(symbol, date)) for symbol in symbols]
+        else:
+            holdings = [(symbol, holding) for (symbol, holding) in index.holdings(date).items() if holding[0] > 1e-9]
+    except Exception as e:
+        print(e)
+        return
+    for (symbol, (amount, cost_basis)) in holdings:
+        print(f"{date.strftime('%Y-%m-%d %H:%M').ljust(18)}{str(symbol)[:11].ljust(12)}{amount:>20.8f}{cost_basis:>16.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the amount and cost basis of coins at given dates')
+    parser.add_argument('--trades', nargs='+', help='Read trades from csv, parquet or arrow files', default=['data/trades.csv'])
+    parser.add_argument('--query', nargs='+', action='append', help='A date, an optional time and the coins to print, all coins held if none are given, can be given several times')
+    parser.add_argument('--exclude-groups', nargs='*', help='Exclude cointracking group from the holdings', default=[])
+    parser.add_argument('--cointracking-usd', help='Use this flag if you have configured cointracking calculate prices in USD.', action='store_true')
+    parser.add_argument('--cointracking-currency', type=report.currency_code, help='The currency cointracking has been configured to calculate prices in.', default='SEK')
+    parser.add_argument('--no-cache', help='Always parse the trades instead of reusing the trades parsed by an earlier run', action='store_true')
+    parser.add_argument('--max-overdraft', type=float, help='The maximum overdraft to allow for each coin.', default=1e-9)
+    parser.add_argument('--checkpoint-interval', type=int, help='Number of trades of a coin between stored states, a query replays at most this many trades of each coin.', default=64)
+    opts = parser.parse_args(argv)
+    if opts.checkpoint_interval < 1:
+        parser.error("--checkpoint-interval must be at least 1")
+
+    try:
+        table = costbasis.TradeTable.from_trades(report.read_trades(opts))
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    index = costbasis.HoldingsIndex(table, opts.max_overdraft, exclude_groups=opts.exclude_groups,
+                                    interval=opts.checkpoint_interval)
+
+    print(f"{'Date'.ljust(18)}{'Coin'.ljust(12)}{'Amount'.rjust(20)}{'Cost basis'.rjust(16)}")
+    if opts.query:
+        for words in opts.query:
+            print_holdings(index, words)
+    else:
+        for line in sys.stdin:
+            words = line.split()
+            if words:
+                print_holdings(index, words)
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
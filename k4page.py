@@ -2,6 +2,30 @@ from datetime import datetime
 import os
 
 
+_template_data = {}
+_templates = {}
+
+
+def read_template_data(year):
+    """Return the contents of the K4 template pdf for year, each template is only read once."""
+    template_filename = f"docs/K4-template-{year}.pdf"
+    if template_filename not in _template_data:
+        if not os.path.exists(template_filename):
+            raise Exception(f"K4 template pdf for {year} not available at {template_filename}")
+        with open(template_filename, 'rb') as f:
+            _template_data[template_filename] = f.read()
+    return _template_data[template_filename]
+
+
+def read_template(year):
+    """Return the parsed K4 template pdf for year, which must not be modified, each template is only parsed once."""
+    import pdfrw
+
+    if year not in _templates:
+        _templates[year] = pdfrw.PdfReader(fdata=read_template_data(year))
+    return _templates[year]
+
+
 class K4Section:
     def __init__(self, lines, sums):
         self.lines = lines
@@ -18,11 +42,13 @@ class K4Page:
         self._section_c = section_c
         self._section_d = section_d
 
-    def generate_sru_lines(self):
+    def generate_sru_lines(self, now=None):
+        """Return the sru lines of the page, now is the generation time to report."""
         k4_page_number_field = 7014
 
         blankettkod = f"K4-{self._year}P4"
-        now = datetime.now()
+        if now is None:
+            now = datetime.now()
         generated_date = now.strftime("%Y%m%d")
         generated_time = now.strftime("%H%M%S")
 
@@ -55,9 +81,9 @@ class K4Page:
 
         return lines
 
-    def generate_pdf(self, destination_folder):
+    def generate_pdf_overlays(self):
+        """Return the text overlays for the two pages of the K4 as pdf data."""
         import io
-        import pdfrw
         from reportlab.pdfgen import canvas
 
         field_x_positions = [58, 122, 217, 302, 388, 475]
@@ -95,8 +121,7 @@ class K4Page:
             if self._section_a and self._section_a.lines:
                 generate_section(pdf, self._section_a, 9, 588)
             pdf.save()
-            data.seek(0)
-            return data
+            return data.getvalue()
 
         def generate_page_2_overlay():
             data = io.BytesIO()
@@ -108,30 +133,83 @@ class K4Page:
             if self._section_d and self._section_d.lines:
                 generate_section(pdf, self._section_d, 7, 360)
             pdf.save()
-            data.seek(0)
-            return data
-
-        def merge(overlay_canvases, template_path):
-            template_pdf = pdfrw.PdfReader(template_path)
-            overlay_pdfs = [pdfrw.PdfReader(x) for x in overlay_canvases]
-            for page, data in zip(template_pdf.pages, overlay_pdfs):
-                overlay = pdfrw.PageMerge().add(data.pages[0])[0]
-                pdfrw.PageMerge(page).add(overlay).render()
-            form = io.BytesIO()
-            pdfrw.PdfWriter().write(form, template_pdf)
-            form.seek(0)
-            return form
-
-        def save(form, filename):
-            with open(filename, 'wb') as f:
-                f.write(form.read())
+            return data.getvalue()
+
+        return [generate_page_1_overlay(), generate_page_2_overlay()]
+
+    def generate_pdf_data(self, overlays, template_pdf=None):
+        """Return the pdf of the page with overlays from generate_pdf_overlays() merged onto template_pdf.
+
+        template_pdf is modified, by default the template is parsed for this page alone.
+        """
+        import io
+        import pdfrw
+
+        if template_pdf is None:
+            # PageMerge.render() modifies the pages of the template, so they
+            # can not be shared with other pages.
+            template_pdf = pdfrw.PdfReader(fdata=read_template_data(self._year))
+        overlay_pdfs = [pdfrw.PdfReader(io.BytesIO(x)) for x in overlays]
+        for page, data in zip(template_pdf.pages, overlay_pdfs):
+            overlay = pdfrw.PageMerge().add(data.pages[0])[0]
+            pdfrw.PageMerge(page).add(overlay).render()
+        form = io.BytesIO()
+        pdfrw.PdfWriter().write(form, template_pdf)
+        return form.getvalue()
+
+    def pdf_filename(self):
+        return "k4_no%02d.pdf" % self._page_number
 
+    def generate_pdf(self, destination_folder):
         if not os.path.exists(destination_folder):
             os.makedirs(destination_folder)
-        pagestr = "%02d" % self._page_number
-
-        template_filename = f"docs/K4-template-{self._year}.pdf"
-        if not os.path.exists(template_filename):
-            raise Exception(f"K4 template pdf for {self._year} not available at {template_filename}")
-        form = merge([generate_page_1_overlay(), generate_page_2_overlay()], template_path=template_filename)
-        save(form, filename=f"{destination_folder}/k4_no{pagestr}.pdf")
+        with open(os.path.join(destination_folder, self.pdf_filename()), 'wb') as f:
+            f.write(self.generate_pdf_data(self.generate_pdf_overlays()))
+
+
+def _merged_page(template_page, overlay_page):
+    # The new page shares content streams, fonts and images with the template
+    # page, only the resource dictionaries which PageMerge.render() modifies
+    # are copied.
+    import pdfrw
+
+    page = pdfrw.PdfDict(indirect=True)
+    page.Type = pdfrw.PdfName.Page
+    page.Contents = template_page.Contents
+    page.MediaBox = template_page.inheritable.MediaBox
+    page.CropBox = template_page.inheritable.CropBox
+    page.Rotate = template_page.inheritable.Rotate
+    resources = template_page.inheritable.Resources
+    page.Resources = pdfrw.PdfDict(resources) if resources is not None else pdfrw.PdfDict()
+    if page.Resources.XObject is not None:
+        page.Resources.XObject = pdfrw.PdfDict(page.Resources.XObject)
+    if template_page.Annots:
+        annots = pdfrw.PdfArray()
+        for template_annot in template_page.Annots:
+            annot = pdfrw.PdfDict(template_annot)
+            annot.indirect = True
+            annot.P = None
+            annots.append(annot)
+        page.Annots = annots
+
+    overlay = pdfrw.PageMerge().add(overlay_page)[0]
+    return pdfrw.PageMerge(page).add(overlay).render()
+
+
+def write_merged_pdf(pages, filename, overlays=None):
+    """Write all K4 pages to a single pdf-file.
+
+    overlays can be given as an iterable of K4Page.generate_pdf_overlays()
+    results, e.g. rendered in other processes, otherwise they are rendered here.
+    """
+    import io
+    import pdfrw
+
+    if overlays is None:
+        overlays = (page.generate_pdf_overlays() for page in pages)
+    writer = pdfrw.PdfWriter(filename)
+    for (page, page_overlays) in zip(pages, overlays):
+        template_pdf = read_template(page._year)
+        for (template_page, overlay) in zip(template_pdf.pages, page_overlays):
+            writer.addpage(_merged_page(template_page, pdfrw.PdfReader(io.BytesIO(overlay)).pages[0]))
+    writer.write()
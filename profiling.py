@@ -0,0 +1,156 @@
+"""Stage level profiling of the report generation.
+
+The stages are marked with profiling.stage(), which does nothing unless a
+Profiler is active, so the same instrumentation can be used when tax and
+taxdata are imported as libraries:
+
+    with profiling.Profiler() as profiler:
+        with profiling.stage("tax computation") as stage:
+            tax_events = tax.compute_tax(...)
+            stage.items = len(tax_events)
+    profiler.print_report()
+
+For every stage the wall time, cpu time, peak resident set size of the
+process at the end of the stage and the number of items handled are
+recorded.
+"""
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+_active = None
+
+
+def _peak_rss():
+    """Return the peak resident set size of the process in bytes, None if not available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes except on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageRecord:
+    def __init__(self, name, depth, start):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss = None
+        self.items = None
+
+    def to_json(self):
+        return {"name": self.name,
+                "depth": self.depth,
+                "start": self.start,
+                "wall_seconds": self.wall_seconds,
+                "cpu_seconds": self.cpu_seconds,
+                "peak_rss": self.peak_rss,
+                "items": self.items}
+
+
+class _NullRecord:
+    # Accepts the attributes set on a StageRecord when no profiler is active.
+    def __setattr__(self, name, value):
+        pass
+
+
+class Profiler:
+    """Records the stages run while it is active.
+
+    With cprofile=True the stages are also run under cProfile, the
+    statistics can then be written with dump_stats().
+    """
+
+    def __init__(self, cprofile=False):
+        self.stages = []
+        self._depth = 0
+        self._start = None
+        self._cprofile = None
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise Exception("A profiler is already active")
+        _active = self
+        self._start = time.perf_counter()
+        if self._cprofile:
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        if self._cprofile:
+            self._cprofile.disable()
+        _active = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = StageRecord(name, self._depth, time.perf_counter() - self._start)
+        self.stages.append(record)
+        self._depth += 1
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall_start
+            record.cpu_seconds = time.process_time() - cpu_start
+            record.peak_rss = _peak_rss()
+            self._depth -= 1
+
+    def print_report(self, file=None):
+        print(f"{'Stage'.ljust(24)}{'Wall s'.rjust(10)}{'CPU s'.rjust(10)}{'Peak RSS MB'.rjust(13)}{'Items'.rjust(10)}",
+              file=file)
+        for record in self.stages:
+            name = ("  " * record.depth + record.name)[:23]
+            peak_rss = f"{record.peak_rss / 1e6:.1f}" if record.peak_rss is not None else "-"
+            items = str(record.items) if record.items is not None else "-"
+            print(f"{name.ljust(24)}{record.wall_seconds:10.3f}{record.cpu_seconds:10.3f}{peak_rss.rjust(13)}"
+                  f"{items.rjust(10)}", file=file)
+
+    def write_trace(self, filename):
+        """Write the stages as json in the trace event format, which can be viewed in chrome://tracing."""
+        events = []
+        for record in self.stages:
+            events.append({"name": record.name,
+                           "ph": "X",
+                           "pid": os.getpid(),
+                           "tid": 0,
+                           "ts": record.start * 1e6,
+                           "dur": record.wall_seconds * 1e6,
+                           "args": {"cpu_seconds": record.cpu_seconds,
+                                    "peak_rss": record.peak_rss,
+                                    "items": record.items}})
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "stages": [record.to_json() for record in self.stages]}, f, indent=2)
+
+    def dump_stats(self, filename):
+        """Write the cProfile statistics in the pstats format."""
+        if not self._cprofile:
+            raise Exception("The profiler was not created with cprofile=True")
+        self._cprofile.dump_stats(filename)
+
+
+def is_active():
+    return _active is not None
+
+
+def stage(name):
+    """Context manager recording a stage in the active profiler, if any.
+
+    The items attribute of the yielded record can be set to the number of
+    items handled by the stage.
+    """
+    if _active is None:
+        return contextlib.nullcontext(_NullRecord())
+    return _active.stage(name)
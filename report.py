@@ -1,10 +1,13 @@
 import argparse
+import contextlib
 import datetime
 import os
 import sys
 from enum import Enum
 
-from taxdata import PersonalDetails, Trades, TaxEvent
+from taxdata import MAX_TRADES_IN_MEMORY, PersonalDetails, Trades, TaxEvent, merge_trades, read_trades_csv, sort_trades
+import arrowio
+import profiling
 import tax
 
 
@@ -15,57 +18,308 @@ class Format(Enum):
     def __str__(self):
         return self.value
 
-parser = argparse.ArgumentParser(description='Swedish cryptocurrency tax reporting script')
-parser.add_argument('year', type=int,
-                    help='Tax year to create report for')
-parser.add_argument('--trades', help='Read trades from csv file', default='data/trades.csv')
-parser.add_argument('--out', help='Output folder', default='out')
-parser.add_argument('--format', type=Format, choices=list(Format), default=Format.sru,
-                    help='The file format of the generated report')
-parser.add_argument('--decimal-sru', help='Report decimal amounts in sru mode (not supported by Skatteverket yet)', action='store_true')
-parser.add_argument('--exclude-groups', nargs='*', help='Exclude cointracking group from report')
-parser.add_argument('--coin-report', help='Generate report of remaining coins and their cost basis at end of year', action='store_true')
-parser.add_argument('--simplified-k4', help='Generate simplified K4 with only two line per coin type (aggregated profit and loss).', action='store_true')
-parser.add_argument('--rounding-report', help='Generate report of roundings done which can be pasted in Ovriga Upplysningar, the file will be put in the out folder.', action='store_true')
-parser.add_argument('--rounding-report-threshold', help='The number of percent difference required for an amount to be included in the report.', default='1')
-parser.add_argument('--cointracking-usd', help='Use this flag if you have configured cointracking calculate prices in USD. Conversion from USD to SEK will then be done by this script instead.', action='store_true')
-parser.add_argument('--max-overdraft', type=float, help='The maximum overdraft to allow for each coin, at the event of an overdraft the coin balance will be set to zero.', default=1e-9)
-opts = parser.parse_args()
-
-if not os.path.isdir(opts.out):
-    os.makedirs(opts.out)
-
-personal_details = PersonalDetails.read_from("data/personal_details.json")
-trades = Trades.read_from(opts.trades, opts.cointracking_usd)
-stock_tax_events = TaxEvent.read_stock_tax_events_from("data/stocks.json") if os.path.exists("data/stocks.json") else None
-
-tax_events = tax.compute_tax(trades,
-                             datetime.datetime(year=opts.year,month=1,day=1,hour=0, minute=0),
-                             datetime.datetime(year=opts.year,month=12,day=31,hour=23, minute=59),
-                             opts.max_overdraft,
-                             exclude_groups=opts.exclude_groups if opts.exclude_groups else [],
-                             coin_report_filename=os.path.join(opts.out, "coin_report.csv") if opts.coin_report else None
-                             )
-if tax_events is None:
-    print(f"Aborting tax computation.")
-    sys.exit(1)
-
-if opts.simplified_k4:
-    tax_events = tax.aggregate_per_coin(tax_events)
-
-if opts.format == Format.sru and not opts.decimal_sru:
-    if opts.rounding_report:
-        threshold = float(opts.rounding_report_threshold) / 100.0
-        tax.rounding_report(tax_events, threshold, os.path.join(opts.out, "rounding_report.txt"))
-    tax_events = tax.convert_to_integer_amounts(tax_events)
-
-tax_events = tax.convert_sek_to_integer_amounts(tax_events)
-
-pages = tax.generate_k4_pages(opts.year, personal_details, tax_events, stock_tax_events=stock_tax_events)
-
-if opts.format == Format.sru:
-    tax.generate_k4_sru(pages, personal_details, opts.out)
-elif opts.format == Format.pdf:
-    tax.generate_k4_pdf(pages, opts.out)
-
-tax.output_totals(tax_events, stock_tax_events=stock_tax_events)
+
+def currency_code(value):
+    """Argument type of a three letter currency code such as EUR."""
+    import fx
+    if not fx.is_currency_code(value):
+        raise argparse.ArgumentTypeError(f"invalid currency code '{value}', expected three letters such as EUR")
+    return value
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Swedish cryptocurrency tax reporting script')
+    parser.add_argument('year', type=int,
+                        help='Tax year to create report for')
+    parser.add_argument('--trades', nargs='+', help='Read trades from csv, parquet or arrow files, e.g. one per exchange or wallet', default=['data/trades.csv'])
+    parser.add_argument('--out', help='Output folder', default='out')
+    parser.add_argument('--personal-details', help='Read personal details from json file', default='data/personal_details.json')
+    parser.add_argument('--stocks', help='Read stock trades for section A from json file if it exists', default='data/stocks.json')
+    parser.add_argument('--format', type=Format, choices=list(Format), default=Format.sru,
+                        help='The file format of the generated report')
+    parser.add_argument('--decimal-sru', help='Report decimal amounts in sru mode (not supported by Skatteverket yet)', action='store_true')
+    parser.add_argument('--exclude-groups', nargs='*', help='Exclude cointracking group from report')
+    parser.add_argument('--coin-report', help='Generate report of remaining coins and their cost basis at end of year', action='store_true')
+    parser.add_argument('--simplified-k4', help='Generate simplified K4 with only two line per coin type (aggregated profit and loss).', action='store_true')
+    parser.add_argument('--rounding-report', help='Generate report of roundings done which can be pasted in Ovriga Upplysningar, the file will be put in the out folder.', action='store_true')
+    parser.add_argument('--rounding-report-threshold', help='The number of percent difference required for an amount to be included in the report.', default='1')
+    parser.add_argument('--prefix-amounts', help='Report crypto amounts in milli or micro units in sru mode when rounding to whole coins would lose too much precision.', action='store_true')
+    parser.add_argument('--prefix-tolerance', type=float, help='The number of percent rounding loss allowed before a smaller unit is used with --prefix-amounts.', default=10.0)
+    parser.add_argument('--cointracking-usd', help='Use this flag if you have configured cointracking calculate prices in USD. Conversion from USD to SEK will then be done by this script instead.', action='store_true')
+    parser.add_argument('--cointracking-currency', type=currency_code, help='The currency cointracking has been configured to calculate prices in, conversion to SEK is then done by this script with the rates in data/rates.', default='SEK')
+    parser.add_argument('--max-overdraft', type=float, help='The maximum overdraft to allow for each coin, at the event of an overdraft the coin balance will be set to zero.', default=1e-9)
+    parser.add_argument('--merged-pdf', help='Write all K4 pages to a single k4.pdf instead of one file per page', action='store_true')
+    parser.add_argument('--jobs', type=int, help='Number of processes to render pdf pages and to compute coins in with the columnar engine', default=1)
+    parser.add_argument('--engine', choices=['serial', 'columnar'], default='serial',
+                        help='The cost basis engine to use, columnar computes each coin separately from a column oriented trade table. It is no faster than serial in a single process, use it with --jobs to compute the coins in parallel.')
+    parser.add_argument('--snapshots', help='Folder to store coin states at each year end in, later runs resume from the latest snapshot which still matches the trades.')
+    parser.add_argument('--export', choices=['parquet', 'arrow'],
+                        help='Also write the computed tax events and the coin balances at the end of the year to the out folder in this format')
+    parser.add_argument('--no-cache', help='Always parse the trades and compute the tax instead of reusing the parsed trades and the result of an earlier run', action='store_true')
+    parser.add_argument('--cache-folder', help='Folder to cache computed tax events in', default='data/cache')
+    parser.add_argument('--cache-size-mb', type=float, help='The maximum size of the cache, the least recently used results are removed when it is exceeded', default=100.0)
+    parser.add_argument('--profile', help='Print wall time, cpu time, peak memory and item count of each stage of the report generation', action='store_true')
+    parser.add_argument('--profile-trace', help='Write the profiled stages as a json trace to this file, implies --profile')
+    parser.add_argument('--profile-stats', help='Run under cProfile and write the statistics in pstats format to this file, implies --profile')
+    return parser
+
+
+def read_stock_tax_events(opts):
+    return TaxEvent.read_stock_tax_events_from(opts.stocks) if os.path.exists(opts.stocks) else None
+
+
+def value_currency(opts):
+    return 'USD' if opts.cointracking_usd else opts.cointracking_currency.upper()
+
+
+def read_trades_file(filename, value_currency, convert=True, source=None):
+    """Yield the trades of a csv, parquet or arrow file in file order."""
+    if arrowio.is_arrow_file(filename):
+        return arrowio.read_trades(filename, value_currency, convert, source)
+    return read_trades_csv(filename, value_currency, convert, source)
+
+
+def read_trades(opts, fingerprints=None):
+    """Return the trades of all trade files merged in chronological order.
+
+    The trades are streamed while the tax is computed, except when profiling
+    where parsing and currency conversion are run as separate stages. When
+    several files are given the trades tell which file they came from. If
+    fingerprints is a list, the trades_fingerprint() of the trades is
+    appended to it.
+    """
+    sources = opts.trades if len(opts.trades) > 1 else [None]
+    convert = not profiling.is_active()
+
+    def read_files():
+        # Run in the parse stage, tradecache parses when the columns are read
+        # and the other files when their trades are sorted.
+        files_columns = []
+        files_trades = []
+        for (filename, source) in zip(opts.trades, sources):
+            if opts.no_cache or arrowio.is_arrow_file(filename):
+                files_columns.append(None)
+                trades = read_trades_file(filename, value_currency(opts), convert, source)
+            else:
+                import tradecache
+                columns = tradecache.read_columns(filename, value_currency(opts), source)
+                files_columns.append(columns)
+                trades = tradecache.trades_of(columns, value_currency(opts), convert, source)
+            files_trades.append(sort_trades(trades, MAX_TRADES_IN_MEMORY))
+        if fingerprints is not None:
+            fingerprints.append(trades_fingerprint(files_columns, value_currency(opts)))
+        return files_trades
+
+    if not profiling.is_active():
+        return merge_trades(read_files())
+
+    with profiling.stage("parse") as stage:
+        trades = list(merge_trades(read_files()))
+        stage.items = len(trades)
+    if value_currency(opts) != 'SEK':
+        import fx
+        with profiling.stage("fx conversion") as stage:
+            trades = list(fx.FxTable().convert_trades(trades, value_currency(opts), 'SEK'))
+            stage.items = len(trades)
+    return Trades(trades)
+
+
+def trades_fingerprint(files_columns, value_currency, fx_table=None):
+    """Return a function giving a digest of the trades before a date, for snapshots.CostBasisSnapshots.for_trades().
+
+    The digest covers the rows of each file before the date and the rates
+    used to convert them. None is returned if a file was not read through
+    tradecache.read_columns().
+    """
+    if None in files_columns:
+        return None
+    import hashlib
+    if fx_table is None:
+        import fx
+        fx_table = fx.FxTable()
+
+    legs = fx_table.path(value_currency, 'SEK')
+
+    def fingerprint(date):
+        sha1 = hashlib.sha1(value_currency.encode("utf-8"))
+        for (_, rates, inverse) in legs:
+            sha1.update(b'1' if inverse else b'0')
+            sha1.update(rates.digest_before(date))
+        for columns in files_columns:
+            digest = columns.digest_before(date)
+            if digest is None:
+                return None
+            sha1.update(digest)
+        return sha1.hexdigest()
+
+    return fingerprint
+
+
+def generate_report(opts, year, personal_details, tax_events, stock_tax_events, out):
+    """Write the report for the tax events of year to the folder out."""
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
+    with profiling.stage("aggregation") as stage:
+        stage.items = len(tax_events)
+        if opts.simplified_k4:
+            tax_events = tax.aggregate_per_coin(tax_events)
+
+        if opts.format == Format.sru and not opts.decimal_sru:
+            # The rounding report shows the roundings to the units the amounts are reported in.
+            coin_prefixes = tax.select_coin_prefixes(tax_events, opts.prefix_tolerance / 100.0) if opts.prefix_amounts else None
+            if opts.rounding_report:
+                threshold = float(opts.rounding_report_threshold) / 100.0
+                tax.rounding_report(tax_events, threshold, os.path.join(out, "rounding_report.txt"), coin_prefixes)
+            if opts.prefix_amounts:
+                tax_events = tax.convert_to_integer_amounts_with_prefix(tax_events, coin_prefixes=coin_prefixes)
+            else:
+                tax_events = tax.convert_to_integer_amounts(tax_events)
+
+        tax_events = tax.convert_sek_to_integer_amounts(tax_events)
+
+        summary = tax.TaxSummary(tax_events, stock_tax_events)
+
+    if opts.format == Format.sru and not profiling.is_active():
+        # The pages are laid out while the sru file is written.
+        pages = tax.iter_k4_pages(year, personal_details, tax_events, stock_tax_events=stock_tax_events, summary=summary)
+    else:
+        with profiling.stage("page layout") as stage:
+            pages = tax.generate_k4_pages(year, personal_details, tax_events, stock_tax_events=stock_tax_events, summary=summary)
+            stage.items = len(pages)
+
+    with profiling.stage("render") as stage:
+        if opts.format == Format.sru:
+            tax.generate_k4_sru(pages, personal_details, out)
+        elif opts.format == Format.pdf:
+            tax.generate_k4_pdf(pages, out, jobs=opts.jobs, merged=opts.merged_pdf)
+        if isinstance(pages, list):
+            stage.items = len(pages)
+
+    tax.output_totals(tax_events, stock_tax_events=stock_tax_events, summary=summary)
+
+
+def compute_tax_events(opts, trades, snapshots=None, coin_states=None):
+    """Compute the tax events of opts.year with the engine selected in opts, returns None if the computation failed."""
+    from_date = datetime.datetime(year=opts.year,month=1,day=1,hour=0, minute=0)
+    to_date = datetime.datetime(year=opts.year,month=12,day=31,hour=23, minute=59)
+    exclude_groups = opts.exclude_groups if opts.exclude_groups else []
+    coin_report_filename = os.path.join(opts.out, "coin_report.csv") if opts.coin_report else None
+    with profiling.stage("tax computation") as stage:
+        if opts.engine == 'columnar':
+            import costbasis
+            try:
+                # The trades are read while the table is built.
+                table = costbasis.TradeTable.from_trades(trades)
+            except Exception as e:
+                print(e)
+                return None
+            tax_events = costbasis.compute_tax(table,
+                                               from_date, to_date, opts.max_overdraft,
+                                               exclude_groups=exclude_groups,
+                                               coin_report_filename=coin_report_filename,
+                                               jobs=opts.jobs,
+                                               coin_states=coin_states)
+        else:
+            tax_events = tax.compute_tax(trades, from_date, to_date, opts.max_overdraft,
+                                         exclude_groups=exclude_groups,
+                                         coin_report_filename=coin_report_filename,
+                                         snapshots=snapshots,
+                                         coin_states=coin_states
+                                         )
+        if tax_events is not None:
+            stage.items = len(tax_events)
+    return tax_events
+
+
+def result_cache_key(cache, opts, year):
+    """Return the key in the resultcache.ResultCache cache of the tax events of year computed with opts."""
+    import fx
+    return cache.key(opts.trades, fx.FxTable().rates_filenames(value_currency(opts), 'SEK'),
+                     opts.exclude_groups if opts.exclude_groups else [], opts.max_overdraft,
+                     value_currency(opts), year)
+
+
+def run(opts):
+    personal_details = PersonalDetails.read_from(opts.personal_details)
+    stock_tax_events = read_stock_tax_events(opts)
+
+    cache = None
+    cached = None
+    try:
+        if not opts.no_cache:
+            from resultcache import ResultCache
+            with profiling.stage("cache lookup"):
+                cache = ResultCache(opts.cache_folder, int(opts.cache_size_mb * 1e6))
+                cache_key = result_cache_key(cache, opts, opts.year)
+                cached = cache.load(cache_key)
+        if cached is None:
+            fingerprints = []
+            trades = read_trades(opts, fingerprints)
+    except Exception as e:
+        print(e)
+        print(f"Aborting tax computation.")
+        sys.exit(1)
+
+    if cached is not None:
+        (tax_events, coin_states) = cached
+        if opts.coin_report:
+            tax.write_coin_report(tax.coins_from_states(coin_states, opts.max_overdraft),
+                                  os.path.join(opts.out, "coin_report.csv"))
+    else:
+        snapshots = None
+        if opts.snapshots:
+            if fingerprints[0] is None:
+                print("Snapshots are only used for csv-files read with the trade cache.")
+            else:
+                from snapshots import CostBasisSnapshots
+                snapshots = CostBasisSnapshots(opts.snapshots).for_trades(fingerprints[0])
+        period_coin_states = []
+        tax_events = compute_tax_events(opts, trades, snapshots, period_coin_states)
+        if tax_events is None:
+            print(f"Aborting tax computation.")
+            sys.exit(1)
+        coin_states = period_coin_states[0]
+        if cache:
+            try:
+                cache.save(cache_key, tax_events, coin_states)
+            except OSError as e:
+                print(f"Could not cache the computed tax: {e}")
+
+    if opts.export:
+        try:
+            arrowio.write_tax_events(tax_events, os.path.join(opts.out, f"tax_events.{opts.export}"))
+            arrowio.write_coin_balances(coin_states, os.path.join(opts.out, f"coin_balances.{opts.export}"))
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+
+    generate_report(opts, opts.year, personal_details, tax_events, stock_tax_events, opts.out)
+
+
+def main(argv=None):
+    parser = build_parser()
+    opts = parser.parse_args(argv)
+    if opts.snapshots and opts.engine != 'serial':
+        parser.error("--snapshots is only supported by the serial engine")
+
+    if not os.path.isdir(opts.out):
+        os.makedirs(opts.out)
+
+    profiler = None
+    if opts.profile or opts.profile_trace or opts.profile_stats:
+        profiler = profiling.Profiler(cprofile=bool(opts.profile_stats))
+
+    with profiler if profiler else contextlib.nullcontext():
+        run(opts)
+
+    if profiler:
+        profiler.print_report()
+        if opts.profile_trace:
+            profiler.write_trace(opts.profile_trace)
+        if opts.profile_stats:
+            profiler.dump_stats(opts.profile_stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Content addressed cache of computed tax events.
+
+The tax events and the coin states at the end of the year are stored in a
+compact binary file named by a hash of the trades files, the rates files and
+the options which affect the tax computation. A later run with the same
+input can then go straight to generating the report.
+"""
+from array import array
+import hashlib
+import os
+import struct
+
+from taxdata import TaxEvent, replacing_file
+
+
+# Magic, number of names, tax events and coins. The names are stored as
+# lengths and utf-8 data, followed by the tax events as name index, amount,
+# income and cost columns and the coins as name index, amount and cost basis
+# columns.
+_HEADER = struct.Struct('=8sqqq')
+_MAGIC = b'CTSRES01'
+
+
+def _file_digest(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _read_array(f, typecode, count):
+    a = array(typecode)
+    a.fromfile(f, count)
+    return a
+
+
+class ResultCache:
+    """Cached tax computations stored in folder, using at most max_bytes.
+
+    The least recently used results are evicted when the cache grows larger
+    than max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def key(self, trades_filenames, rates_filenames, exclude_groups, max_overdraft, value_currency, year, native_currency='SEK'):
+        """Return the cache key for computing the tax of year from trades_filenames.
+
+        rates_filenames are the files of rates used to convert the values of
+        the trades from value_currency.
+        """
+        params = repr(([_file_digest(trades_filename) for trades_filename in trades_filenames],
+                       [_file_digest(rates_filename) for rates_filename in rates_filenames],
+                       sorted(exclude_groups), max_overdraft, value_currency, year, native_currency))
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.folder, f"{key}.bin")
+
+    def load(self, key):
+        """Return (tax_events, coins) stored for key or None, coins is a {symbol: (amount, cost_basis)} dict."""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                (magic, name_count, event_count, coin_count) = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != _MAGIC:
+                    return None
+                name_lengths = _read_array(f, 'q', name_count)
+                names = []
+                for length in name_lengths:
+                    names.append(f.read(length).decode("utf-8"))
+                event_names = _read_array(f, 'i', event_count)
+                amounts = _read_array(f, 'd', event_count)
+                incomes = _read_array(f, 'd', event_count)
+                costs = _read_array(f, 'd', event_count)
+                coin_names = _read_array(f, 'i', coin_count)
+                coin_amounts = _read_array(f, 'd', coin_count)
+                cost_bases = _read_array(f, 'd', coin_count)
+        except (OSError, EOFError, UnicodeDecodeError, struct.error):
+            return None
+
+        # Mark as recently used for the eviction.
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        tax_events = [TaxEvent(amount, names[name], income, cost)
+                      for (name, amount, income, cost) in zip(event_names, amounts, incomes, costs)]
+        coins = {names[name]: (amount, cost_basis) for (name, amount, cost_basis) in zip(coin_names, coin_amounts, cost_bases)}
+        return (tax_events, coins)
+
+    def save(self, key, tax_events, coins):
+        """Store tax_events and the {symbol: (amount, cost_basis)} dict coins for key."""
+        name_indices = {}
+
+        def name_index(name):
+            index = name_indices.get(name)
+            if index is None:
+                index = name_indices[name] = len(name_indices)
+            return index
+
+        event_names = array('i', [name_index(tax_event.name) for tax_event in tax_events])
+        coin_names = array('i', [name_index(symbol) for symbol in coins])
+        encoded_names = [name.encode("utf-8") for name in name_indices]
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        filename = self._filename(key)
+        with replacing_file(filename) as f:
+            f.write(_HEADER.pack(_MAGIC, len(encoded_names), len(tax_events), len(coins)))
+            array('q', [len(name) for name in encoded_names]).tofile(f)
+            for name in encoded_names:
+                f.write(name)
+            event_names.tofile(f)
+            array('d', [tax_event.amount for tax_event in tax_events]).tofile(f)
+            array('d', [tax_event.income for tax_event in tax_events]).tofile(f)
+            array('d', [tax_event.cost for tax_event in tax_events]).tofile(f)
+            coin_names.tofile(f)
+            array('d', [amount for (amount, _) in coins.values()]).tofile(f)
+            array('d', [cost_basis for (_, cost_basis) in coins.values()]).tofile(f)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used results until the cache is no larger than max_bytes."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".bin"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry_size for (_, entry_size, _) in entries)
+        for (_, entry_size, path) in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
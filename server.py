@@ -0,0 +1,271 @@
+"""Local http server generating reports without starting a new process per report.
+
+A report is requested by posting a json document to /report
+
+    {
+        "portfolio": "client1",
+        "year": 2019,
+        "trades": "<contents of the cointracking csv-file>",
+        "personal_details": {"namn": ..., "personnummer": ..., "postnummer": ..., "postort": ...},
+        "stocks": {...},
+        "options": ["--simplified-k4", "--format", "pdf"]
+    }
+
+where stocks is optional and has the format of data/stocks.json and options
+are given as to report.py. The generated files are returned as a zip
+archive together with report.log, the output report.py would have printed.
+
+Reports are generated in a pool of worker processes which keep the currency
+rates and the parsed K4 templates loaded between requests. Requests for the
+same portfolio are always sent to the same worker, which keeps the parsed
+trades and the year end coin states of the most recently used portfolios so
+that a repeated request only has to parse the new trades and process the
+trades of the reported year.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from taxdata import PersonalDetails, read_trades_csv, sort_trades
+from fx import FxTable
+from snapshots import MemorySnapshots
+import report
+import tradecache
+
+
+# Options of report.py which can be given in a request, the others refer to
+# files on the server.
+ALLOWED_OPTIONS = ['--format', '--decimal-sru', '--exclude-groups', '--coin-report', '--simplified-k4',
+                   '--rounding-report', '--rounding-report-threshold', '--prefix-amounts', '--prefix-tolerance',
+                   '--cointracking-usd', '--cointracking-currency', '--max-overdraft', '--merged-pdf', '--engine']
+
+
+class RequestError(Exception):
+    pass
+
+
+# State of a worker process.
+_max_portfolios = 16
+_portfolios = OrderedDict()
+_portfolio_ids = itertools.count()
+_cache_folder = None
+_fx = FxTable()
+
+
+def _init_worker(max_portfolios):
+    global _max_portfolios
+    _max_portfolios = max_portfolios
+
+
+class _Portfolio:
+    """The year end coin states and the parsed trades a worker keeps of a portfolio."""
+
+    def __init__(self, folder):
+        self.snapshots = MemorySnapshots()
+        self.trades_cache_filename = os.path.join(folder, f"{next(_portfolio_ids)}.bin")
+
+    def remove(self):
+        try:
+            os.remove(self.trades_cache_filename)
+        except OSError:
+            pass
+
+
+def _portfolio_state(portfolio):
+    """Return the state of portfolio, evicting the least recently used portfolio if too many are kept."""
+    global _cache_folder
+    state = _portfolios.pop(portfolio, None)
+    if state is None:
+        if _cache_folder is None:
+            _cache_folder = tempfile.TemporaryDirectory()
+        state = _Portfolio(_cache_folder.name)
+    _portfolios[portfolio] = state
+    while len(_portfolios) > _max_portfolios:
+        _portfolios.popitem(last=False)[1].remove()
+    return state
+
+
+def _parse_options(request, tmp):
+    options = request.get("options", [])
+    if not isinstance(options, list) or not all(isinstance(option, str) for option in options):
+        raise RequestError("The options must be a list of strings")
+    for option in options:
+        if option.startswith("-") and option.split("=")[0] not in ALLOWED_OPTIONS:
+            raise RequestError(f"Option {option} is not allowed")
+    if not isinstance(request.get("year"), int):
+        raise RequestError("The year to report must be given")
+
+    argv = [str(request["year"]), '--trades', os.path.join(tmp, "trades.csv"), '--out', os.path.join(tmp, "out"),
+            '--personal-details', os.path.join(tmp, "personal_details.json"), '--stocks', os.path.join(tmp, "stocks.json")]
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            return report.build_parser().parse_args(argv + options)
+    except SystemExit:
+        raise RequestError(stderr.getvalue().strip())
+
+
+def generate(request):
+    """Generate the report of a request, returns (ok, data) where data is the zip archive or the log if not ok."""
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            opts = _parse_options(request, tmp)
+            with open(opts.trades[0], "w", encoding="utf-8") as f:
+                f.write(request["trades"])
+            with open(opts.personal_details, "w", encoding="utf-8") as f:
+                json.dump(request["personal_details"], f)
+            if "stocks" in request:
+                with open(opts.stocks, "w", encoding="utf-8") as f:
+                    json.dump(request["stocks"], f)
+        except (KeyError, TypeError) as e:
+            raise RequestError(f"Invalid request: {e}")
+        os.makedirs(opts.out)
+
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            ok = _generate_report(request.get("portfolio"), opts)
+        if not ok:
+            return (False, log.getvalue())
+
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("report.log", log.getvalue())
+            for (folder, _, filenames) in os.walk(opts.out):
+                for filename in sorted(filenames):
+                    path = os.path.join(folder, filename)
+                    archive.write(path, os.path.relpath(path, opts.out))
+        return (True, data.getvalue())
+
+
+def _generate_report(portfolio, opts):
+    try:
+        personal_details = PersonalDetails.read_from(opts.personal_details)
+        snapshots = None
+        if portfolio is None:
+            trades = read_trades_csv(opts.trades[0], report.value_currency(opts), convert=False)
+        else:
+            # Only the trades added since the previous request are parsed.
+            state = _portfolio_state(portfolio)
+            columns = tradecache.read_columns(opts.trades[0], report.value_currency(opts),
+                                              cache_filename=state.trades_cache_filename)
+            trades = columns.trades()
+            if opts.engine == 'serial':
+                snapshots = state.snapshots.for_trades(report.trades_fingerprint([columns], report.value_currency(opts), _fx))
+        if report.value_currency(opts) != 'SEK':
+            trades = _fx.convert_trades(trades, report.value_currency(opts), 'SEK')
+        trades = sort_trades(trades)
+        stock_tax_events = report.read_stock_tax_events(opts)
+    except Exception as e:
+        print(e)
+        print(f"Aborting tax computation.")
+        return False
+
+    try:
+        tax_events = report.compute_tax_events(opts, trades, snapshots)
+        if tax_events is None:
+            print(f"Aborting tax computation.")
+            return False
+
+        report.generate_report(opts, opts.year, personal_details, tax_events, stock_tax_events, opts.out)
+    except Exception as e:
+        # E.g. a rounding report which is too long, report.py would exit.
+        print(e)
+        print(f"Aborting report generation.")
+        return False
+    return True
+
+
+class ReportServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers, max_portfolios, max_request_bytes):
+        super().__init__(address, ReportRequestHandler)
+        # One single process pool per worker so that a portfolio can be sent
+        # to the worker which has its coin states.
+        self.workers = [ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(max_portfolios,))
+                        for _ in range(workers)]
+        self.max_request_bytes = max_request_bytes
+        self._next_worker = itertools.count()
+
+    def worker_for(self, portfolio):
+        if portfolio is None:
+            return self.workers[next(self._next_worker) % len(self.workers)]
+        return self.workers[hash(portfolio) % len(self.workers)]
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers:
+            worker.shutdown()
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        self._respond(200, "text/plain; charset=utf-8", b"ok\n")
+
+    def do_POST(self):
+        if self.path != "/report":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > self.server.max_request_bytes:
+            self.send_error(413)
+            return
+        try:
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise RequestError("The request must be a json object")
+            portfolio = request.get("portfolio")
+            if portfolio is not None and not isinstance(portfolio, str):
+                raise RequestError("The portfolio must be a string")
+            (ok, data) = self.server.worker_for(portfolio).submit(generate, request).result()
+        except (RequestError, ValueError) as e:
+            self._respond(400, "text/plain; charset=utf-8", f"{e}\n".encode("utf-8"))
+            return
+        except Exception as e:
+            self._respond(500, "text/plain; charset=utf-8", f"{e}\n".encode("utf-8"))
+            return
+        if ok:
+            self._respond(200, "application/zip", data)
+        else:
+            self._respond(422, "text/plain; charset=utf-8", data.encode("utf-8"))
+
+    def _respond(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local http server generating Swedish cryptocurrency tax reports')
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port to listen on', default=8000)
+    parser.add_argument('--workers', type=int, help='Number of worker processes generating reports', default=os.cpu_count())
+    parser.add_argument('--max-portfolios', type=int, help='Number of portfolios to keep coin states in memory for in each worker', default=16)
+    parser.add_argument('--max-request-mb', type=float, help='The maximum size of a request', default=100)
+    opts = parser.parse_args(argv)
+
+    server = ReportServer((opts.host, opts.port), opts.workers, opts.max_portfolios, int(opts.max_request_mb * 1e6))
+    print(f"Serving reports on http://{opts.host}:{opts.port}/report")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
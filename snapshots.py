@@ -0,0 +1,121 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+
+from taxdata import replacing_file
+
+
+class CostBasisSnapshots:
+    """Year end coin states stored as json files in a folder.
+
+    Each snapshot records the fingerprint of the trades before the year end
+    which produced it, so that it is only reused as long as the trade history
+    up to that year end is unchanged.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def for_trades(self, fingerprint):
+        """Return the snapshots to use for the trades whose history before a date has the digest fingerprint(date).
+
+        fingerprint(date) returns None when it can not tell, then no snapshot
+        is used or stored for that date.
+        """
+        return TradeSnapshots(self, fingerprint)
+
+    def _filename(self, year, params_hash):
+        return os.path.join(self.folder, f"{year}-{params_hash[:16]}.json")
+
+    def years(self, params_hash):
+        """Return the years with a stored snapshot for params_hash."""
+        try:
+            filenames = os.listdir(self.folder)
+        except OSError:
+            return []
+        pattern = re.compile(rf"(\d+)-{params_hash[:16]}\.json")
+        return [int(match.group(1)) for match in map(pattern.fullmatch, filenames) if match]
+
+    def load(self, year, params_hash, fingerprint):
+        try:
+            with open(self._filename(year, params_hash), encoding="utf-8") as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if d.get("fingerprint") != fingerprint:
+            return None
+        return {symbol: (amount, cost_basis) for (symbol, (amount, cost_basis)) in d["coins"].items()}
+
+    def save(self, year, params_hash, fingerprint, coins):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        with replacing_file(self._filename(year, params_hash), "w", encoding="utf-8") as f:
+            json.dump({"year": year,
+                       "fingerprint": fingerprint,
+                       "coins": {coin.symbol: [coin.amount, coin.cost_basis] for coin in coins.values()}}, f)
+
+
+class MemorySnapshots(CostBasisSnapshots):
+    """Year end coin states kept in memory, e.g. by a long running server."""
+
+    def __init__(self):
+        super().__init__(None)
+        self._snapshots = {}
+
+    def years(self, params_hash):
+        return [year for (year, snapshot_params_hash) in self._snapshots if snapshot_params_hash == params_hash]
+
+    def load(self, year, params_hash, fingerprint):
+        snapshot = self._snapshots.get((year, params_hash))
+        if snapshot is None or snapshot[0] != fingerprint:
+            return None
+        return snapshot[1]
+
+    def save(self, year, params_hash, fingerprint, coins):
+        self._snapshots[(year, params_hash)] = (
+            fingerprint, {coin.symbol: (coin.amount, coin.cost_basis) for coin in coins.values()})
+
+
+class TradeSnapshots:
+    """The snapshots of a CostBasisSnapshots for the trades with a fingerprint."""
+
+    def __init__(self, snapshots, fingerprint):
+        self._snapshots = snapshots
+        self._fingerprint = fingerprint
+
+    def history(self, max_overdraft, native_currency, exclude_groups):
+        return TradeHistory(self._snapshots, self._fingerprint, max_overdraft, native_currency, exclude_groups)
+
+
+class TradeHistory:
+    """The snapshots of a computation with given options."""
+
+    def __init__(self, snapshots, fingerprint, max_overdraft, native_currency, exclude_groups):
+        self._snapshots = snapshots
+        self._fingerprint = fingerprint
+        params = repr((max_overdraft, native_currency, sorted(exclude_groups)))
+        self._params_hash = hashlib.sha1(params.encode("utf-8")).hexdigest()
+
+    def latest(self, date):
+        """Return (year_end, coins) of the latest snapshot at or before date which matches the trades, or None.
+
+        coins is a {symbol: (amount, cost_basis)} dict.
+        """
+        for year in sorted(self._snapshots.years(self._params_hash), reverse=True):
+            year_end = datetime(year=year + 1, month=1, day=1)
+            if year_end > date:
+                continue
+            fingerprint = self._fingerprint(year_end)
+            if fingerprint is None:
+                continue
+            coins = self._snapshots.load(year, self._params_hash, fingerprint)
+            if coins is not None:
+                return (year_end, coins)
+        return None
+
+    def save(self, year_end, coins):
+        fingerprint = self._fingerprint(year_end)
+        if fingerprint is not None:
+            self._snapshots.save(year_end.year - 1, self._params_hash, fingerprint, coins)
@@ -1,7 +1,8 @@
+from datetime import datetime
 import os
 
-from taxdata import TaxEvent, Trade
-from k4page import K4Section, K4Page
+from taxdata import TaxEvent, Trade, trade_location
+from k4page import K4Section, K4Page, write_merged_pdf
 
 
 def is_fiat(coin):
@@ -9,6 +10,8 @@ def is_fiat(coin):
 
 
 class Coin:
+    __slots__ = ('symbol', 'amount', 'cost_basis', 'max_overdraft')
+
     def __init__(self, symbol, max_overdraft):
         self.symbol = symbol
         self.amount = 0.0
@@ -34,116 +37,274 @@ class Coin:
         return tax_event
 
 
-def compute_tax(trades, from_date, to_date, max_overdraft, native_currency='SEK', exclude_groups=[], coin_report_filename=None):
-    tax_events = []
+def coins_from_states(coin_states, max_overdraft):
+    """Return Coins from a {symbol: (amount, cost_basis)} dict."""
     coins = {}
+    for (symbol, (amount, cost_basis)) in coin_states.items():
+        coin = Coin(symbol, max_overdraft)
+        coin.amount = amount
+        coin.cost_basis = cost_basis
+        coins[symbol] = coin
+    return coins
 
-    def get_buy_coin(trade:Trade):
-        if trade.buy_coin == native_currency:
-            return None
-        if trade.buy_coin not in coins:
-            coins[trade.buy_coin] = Coin(trade.buy_coin, max_overdraft)
-        return coins[trade.buy_coin]
 
-    def get_sell_coin(trade:Trade):
-        if trade.sell_coin == native_currency:
-            return None
-        if trade.sell_coin not in coins:
-            raise Exception(f"Selling currency {trade.sell_coin} which has not been bought yet")
-        return coins[trade.sell_coin]
+def _get_buy_coin(coins, trade:Trade, max_overdraft, native_currency):
+    if trade.buy_coin == native_currency:
+        return None
+    if trade.buy_coin not in coins:
+        coins[trade.buy_coin] = Coin(trade.buy_coin, max_overdraft)
+    return coins[trade.buy_coin]
 
-    for trade in trades.trades:
-        if trade.date > to_date:
-            break
-        elif trade.group in exclude_groups:
-            continue
 
-        try:
+def _get_sell_coin(coins, trade:Trade, native_currency):
+    if trade.sell_coin == native_currency:
+        return None
+    if trade.sell_coin not in coins:
+        raise Exception(f"Selling currency {trade.sell_coin} which has not been bought yet")
+    return coins[trade.sell_coin]
 
-            if trade.type == 'Trade':
-                buy_coin = get_buy_coin(trade)
-                sell_coin = get_sell_coin(trade)
 
-                if trade.sell_coin == native_currency:
-                    value_sek = trade.sell_value
-                else:
-                    value_sek = trade.buy_value
-
-                if buy_coin:
-                    buy_coin.buy(trade.buy_amount, value_sek)
-                if sell_coin:
-                    tax_event = sell_coin.sell(trade.sell_amount, value_sek)
-                    if trade.date >= from_date:
-                        tax_events.append(tax_event)
-
-            elif trade.type == 'Mining':
-                buy_coin = get_buy_coin(trade)
-                if buy_coin:
-                    buy_coin.buy(trade.buy_amount, trade.buy_value)
-
-            elif trade.type == 'Gift/Tip':
-                buy_coin = get_buy_coin(trade)
-                if buy_coin:
-                    buy_coin.buy(trade.buy_amount, 0.0)
-
-            elif trade.type == 'Spend':
-                sell_coin = get_sell_coin(trade)
-                if sell_coin:
-                    tax_event = sell_coin.sell(trade.sell_amount, trade.sell_value)
-                    if trade.date >= from_date:
-                        tax_events.append(tax_event)
+def apply_trade(coins, trade:Trade, max_overdraft, native_currency='SEK') -> TaxEvent:
+    """Update the Coin states in coins with trade and return the TaxEvent of any sale."""
+    if trade.type == 'Trade':
+        buy_coin = _get_buy_coin(coins, trade, max_overdraft, native_currency)
+        sell_coin = _get_sell_coin(coins, trade, native_currency)
 
+        if trade.sell_coin == native_currency:
+            value_sek = trade.sell_value
+        else:
+            value_sek = trade.buy_value
+
+        if buy_coin:
+            buy_coin.buy(trade.buy_amount, value_sek)
+        if sell_coin:
+            return sell_coin.sell(trade.sell_amount, value_sek)
+
+    elif trade.type == 'Mining':
+        buy_coin = _get_buy_coin(coins, trade, max_overdraft, native_currency)
+        if buy_coin:
+            buy_coin.buy(trade.buy_amount, trade.buy_value)
+
+    elif trade.type == 'Gift/Tip':
+        buy_coin = _get_buy_coin(coins, trade, max_overdraft, native_currency)
+        if buy_coin:
+            buy_coin.buy(trade.buy_amount, 0.0)
+
+    elif trade.type == 'Spend':
+        sell_coin = _get_sell_coin(coins, trade, native_currency)
+        if sell_coin:
+            return sell_coin.sell(trade.sell_amount, trade.sell_value)
+
+    return None
+
+
+def write_coin_report(coins, coin_report_filename):
+    with open(coin_report_filename, "w") as f:
+        f.write(f"{'Amount'.ljust(14)}{'Coin'.ljust(8)}{'Cost basis'.ljust(10)}\n")
+        coin_list = [coin for (_, coin) in coins.items() if coin.amount > 1e-9]
+        coin_list.sort(key=lambda coin: coin.symbol)
+        for coin in coin_list:
+            f.write(f"{str(coin.amount)[:12].ljust(14)}{str(coin.symbol).ljust(8)}{str(coin.cost_basis)[:8].ljust(10)}\n")
+
+
+def compute_tax(trades, from_date, to_date, max_overdraft, native_currency='SEK', exclude_groups=[], coin_report_filename=None,
+                snapshots=None, coin_states=None):
+    tax_events = compute_tax_periods(trades, [(from_date, to_date, coin_report_filename)], max_overdraft,
+                                     native_currency=native_currency, exclude_groups=exclude_groups, snapshots=snapshots,
+                                     coin_states=coin_states)
+    return tax_events[0] if tax_events is not None else None
+
+
+def compute_tax_per_year(trades, years, max_overdraft, native_currency='SEK', exclude_groups=[], coin_report_filenames=None,
+                         snapshots=None, coin_states=None):
+    """Compute the tax events for several years in a single pass over trades.
+
+    Returns a dict from year to tax events or None if the computation failed.
+    If coin_states is a dict, the coins at the end of each year are stored in
+    it by year.
+    """
+    years = sorted(set(years))
+    periods = [(datetime(year=year, month=1, day=1, hour=0, minute=0),
+                datetime(year=year, month=12, day=31, hour=23, minute=59),
+                coin_report_filenames.get(year) if coin_report_filenames else None)
+               for year in years]
+    period_coin_states = [] if coin_states is not None else None
+    tax_events = compute_tax_periods(trades, periods, max_overdraft,
+                                     native_currency=native_currency, exclude_groups=exclude_groups, snapshots=snapshots,
+                                     coin_states=period_coin_states)
+    if tax_events is None:
+        return None
+    if coin_states is not None:
+        coin_states.update(zip(years, period_coin_states))
+    return dict(zip(years, tax_events))
+
+
+def compute_tax_periods(trades, periods, max_overdraft, native_currency='SEK', exclude_groups=[], snapshots=None,
+                        coin_states=None):
+    """Compute the tax events for each (from_date, to_date, coin_report_filename) in periods.
+
+    periods must be sorted and non-overlapping. Returns a list with the tax
+    events of each period or None if the computation failed. If coin_states
+    is a list, a {symbol: (amount, cost_basis)} dict with the coins at the
+    end of each period is appended to it.
+    """
+    tax_events = [[] for _ in periods]
+    coins = {}
+    from_date = periods[0][0]
+    exclude_groups = set(exclude_groups)
+    period_index = 0
+
+    # With snapshots the coins are restored from the latest stored year end at
+    # or before from_date, the trades before it are skipped, and the coins are
+    # stored at each year end passed after it.
+    history = snapshots.history(max_overdraft, native_currency, exclude_groups) if snapshots else None
+    resume_date = None
+    next_year_end = None
+    if history:
+        latest = history.latest(from_date)
+        if latest is not None:
+            (resume_date, stored_coins) = latest
+            coins.update(coins_from_states(stored_coins, max_overdraft))
+            next_year_end = datetime(year=resume_date.year + 1, month=1, day=1)
+
+    def process(trade):
+        try:
+            tax_event = apply_trade(coins, trade, max_overdraft, native_currency)
         except Exception as e:
-            print(f"Exception encountered at line {trade.lineno} in trades csv-file: {e}")
-            return None
-
-    if coin_report_filename:
-        with open(coin_report_filename, "w") as f:
-            f.write(f"{'Amount'.ljust(14)}{'Coin'.ljust(8)}{'Cost basis'.ljust(10)}\n")
-            coin_list = [coin for (_, coin) in coins.items() if coin.amount > 1e-9]
-            coin_list.sort(key=lambda coin: coin.symbol)
-            for coin in coin_list:
-                f.write(f"{str(coin.amount)[:12].ljust(14)}{str(coin.symbol).ljust(8)}{str(coin.cost_basis)[:8].ljust(10)}\n")
+            raise Exception(f"Exception encountered at {trade_location(trade.lineno, trade.source)}: {e}")
+        if tax_event and trade.date >= from_date and trade.date >= periods[period_index][0]:
+            tax_events[period_index].append(tax_event)
+
+    def end_period():
+        coin_report_filename = periods[period_index][2]
+        if coin_report_filename:
+            write_coin_report(coins, coin_report_filename)
+        if coin_states is not None:
+            coin_states.append({symbol: (coin.amount, coin.cost_basis) for (symbol, coin) in coins.items()})
+
+    try:
+        for trade in trades:
+            if resume_date is not None and trade.date < resume_date:
+                continue
+            if history:
+                if next_year_end is None:
+                    next_year_end = datetime(year=trade.date.year + 1, month=1, day=1)
+                while next_year_end <= trade.date:
+                    history.save(next_year_end, coins)
+                    next_year_end = datetime(year=next_year_end.year + 1, month=1, day=1)
+
+            while period_index < len(periods) and trade.date > periods[period_index][1]:
+                end_period()
+                period_index += 1
+            if period_index == len(periods):
+                break
+            elif trade.group in exclude_groups:
+                continue
+
+            process(trade)
+
+        while period_index < len(periods):
+            end_period()
+            period_index += 1
+
+    except Exception as e:
+        print(e)
+        return None
 
     return tax_events
 
 
+class TaxSummary:
+    """Tax events split into the K4 sections with per section totals.
+
+    The profit of each tax event is computed once and the split into
+    sections, the per coin profit/loss aggregation and the totals are all
+    done in a single pass over the tax events.
+    """
+
+    def __init__(self, tax_events, stock_tax_events=None):
+        self.fiat_events = []
+        self.fiat_profits = []
+        self.crypto_events = []
+        self.crypto_profits = []
+        self.stock_events = stock_tax_events if stock_tax_events else []
+        self.stock_profits = [x.profit() for x in self.stock_events]
+
+        fiat_total_profit = fiat_total_loss = 0
+        crypto_total_profit = crypto_total_loss = 0
+        coin_aggregates = {}
+        for tax_event in tax_events:
+            name = tax_event.name
+            profit = tax_event.income - tax_event.cost
+            if is_fiat(name):
+                self.fiat_events.append(tax_event)
+                self.fiat_profits.append(profit)
+                if profit > 0:
+                    fiat_total_profit += profit
+                elif profit < 0:
+                    fiat_total_loss += -profit
+            else:
+                self.crypto_events.append(tax_event)
+                self.crypto_profits.append(profit)
+                if profit > 0:
+                    crypto_total_profit += profit
+                elif profit < 0:
+                    crypto_total_loss += -profit
+
+            aggregates = coin_aggregates.get(name)
+            if aggregates is None:
+                aggregates = coin_aggregates[name] = ([0.0, 0.0, 0.0], [0.0, 0.0, 0.0])
+            aggregate = aggregates[0] if profit > 0.0 else aggregates[1]
+            aggregate[0] += tax_event.amount
+            aggregate[1] += tax_event.income
+            aggregate[2] += tax_event.cost
+
+        stock_total_profit = stock_total_loss = 0
+        for profit in self.stock_profits:
+            if profit > 0:
+                stock_total_profit += profit
+            elif profit < 0:
+                stock_total_loss += -profit
+
+        # (profit, loss) per section
+        self.stock_totals = (stock_total_profit, stock_total_loss)
+        self.fiat_totals = (fiat_total_profit, fiat_total_loss)
+        self.crypto_totals = (crypto_total_profit, crypto_total_loss)
+        self._coin_aggregates = coin_aggregates
+
+    def aggregate_per_coin(self):
+        """Return one tax event with the summed profits and one with the summed losses per coin."""
+        new_tax_events = []
+        for name in sorted(self._coin_aggregates):
+            for (amount, income, cost) in self._coin_aggregates[name]:
+                if amount > 0.0:
+                    new_tax_events.append(TaxEvent(amount, name, income, cost))
+        return new_tax_events
+
+
 def aggregate_per_coin(tax_events):
-    aggregate_tax_events = {}
-    for tax_event in tax_events:
-        if tax_event.name not in aggregate_tax_events:
-            aggregate_tax_events[tax_event.name] = (TaxEvent(0.0, tax_event.name, 0.0, 0.0), TaxEvent(0.0, tax_event.name, 0.0, 0.0))
-        (aggregate_profit_tax_event, aggregate_loss_tax_event) = aggregate_tax_events[tax_event.name]
-        if tax_event.profit() > 0.0:
-            aggregate_profit_tax_event.amount += tax_event.amount
-            aggregate_profit_tax_event.income += tax_event.income
-            aggregate_profit_tax_event.cost += tax_event.cost
-        else:
-            aggregate_loss_tax_event.amount += tax_event.amount
-            aggregate_loss_tax_event.income += tax_event.income
-            aggregate_loss_tax_event.cost += tax_event.cost
-
-    sorted_aggregate_events = list(aggregate_tax_events.items())
-    sorted_aggregate_events.sort()
-    new_tax_events = []
-    for (name, (aggregate_profit_tax_event, aggregate_loss_tax_event)) in sorted_aggregate_events:
-        if (aggregate_profit_tax_event.amount > 0.0):
-            new_tax_events.append(aggregate_profit_tax_event)
-        if (aggregate_loss_tax_event.amount > 0.0):
-            new_tax_events.append(aggregate_loss_tax_event)
-    return new_tax_events
-
-
-def rounding_report(tax_events, threshold, report_filename):
+    return TaxSummary(tax_events).aggregate_per_coin()
+
+
+def rounding_report(tax_events, threshold, report_filename, coin_prefixes=None):
+    """Write the roundings of the amounts of tax_events which lose more than threshold.
+
+    coin_prefixes is the select_coin_prefixes() of the coins reported in
+    smaller units with --prefix-amounts, the other amounts are rounded to
+    whole coins.
+    """
+    if coin_prefixes is None:
+        coin_prefixes = {}
     with open(report_filename, 'w', encoding='utf-8') as f:
         f.write(f"Decimaler stöds ej för bilaga K4 på skatteverket.se.\n")
         f.write(f"Här är en lista på avrundningar där det avrundade antalet skiljer sig mer än {str(threshold*100)[:4]}% från det egentliga antalet:\n")
         f.write(f"\n")
         for tax_event in tax_events:
-            original = tax_event.amount
-            rounded = round(tax_event.amount)
+            (prefix, factor) = coin_prefixes.get(tax_event.name, COIN_PREFIXES[0])
+            original = factor * tax_event.amount
+            rounded = round(original)
             if abs(rounded - original) / original > threshold:
-                f.write(f"{original} {tax_event.name} har avrundats till {rounded} {tax_event.name}\n")
+                f.write(f"{original} {prefix}{tax_event.name} har avrundats till {rounded} {prefix}{tax_event.name}\n")
 
     if os.stat(report_filename).st_size > 999:
         raise Exception("Rounding report is longer than 999 characters (the limit on skatteverket.se), consider increasing the threshold --rounding-report-threshold and doing a simplified K4 --simplified-k4.")
@@ -157,22 +318,47 @@ def convert_to_integer_amounts(tax_events):
     return new_events
 
 
-def convert_to_integer_amounts_with_prefix(tax_events, precision_loss_tolerance=0.1):
-    prefixes = [("", 1.0), ("milli", 1000.0), ("micro", 1000000.0)]
+COIN_PREFIXES = [("", 1.0), ("milli", 1000.0), ("micro", 1000000.0)]
+
+
+def select_coin_prefixes(tax_events, precision_loss_tolerance=0.1):
+    """Return the (prefix, factor) to use for each crypto coin in tax_events.
+
+    The first prefix in COIN_PREFIXES where rounding the amount of every tax
+    event for the coin to an integer loses less than precision_loss_tolerance
+    is selected. The worst case loss of all prefixes is computed in a single
+    pass over tax_events.
+    """
+    factors = [factor for (_, factor) in COIN_PREFIXES]
+    max_losses = {}
+    for tax_event in tax_events:
+        coin = tax_event.name
+        losses = max_losses.get(coin)
+        if losses is None:
+            if is_fiat(coin):
+                continue
+            losses = max_losses[coin] = [0.0] * len(factors)
+        for (index, factor) in enumerate(factors):
+            amount = factor * tax_event.amount
+            loss = abs(round(amount) - amount) / amount
+            if loss > losses[index]:
+                losses[index] = loss
 
-    # Check which coins need to be modified to not lose to much precision.
     coin_prefixes = {}
-    coins = set([x.name for x in tax_events])
-    for coin in coins:
-        if not is_fiat(coin):
-            for (prefix, factor) in prefixes:
-                loss = max([abs(round(factor*x.amount) - factor*x.amount) / (factor*x.amount)
-                            for x in tax_events if x.name == coin])
-                if loss < precision_loss_tolerance:
-                    break
-            else:
-                raise Exception("No prefix with low enough loss found")
-            coin_prefixes[coin] = (prefix, factor)
+    for (coin, losses) in max_losses.items():
+        for (prefix_and_factor, loss) in zip(COIN_PREFIXES, losses):
+            if loss < precision_loss_tolerance:
+                coin_prefixes[coin] = prefix_and_factor
+                break
+        else:
+            raise Exception(f"No prefix with low enough loss found for {coin}")
+    return coin_prefixes
+
+
+def convert_to_integer_amounts_with_prefix(tax_events, precision_loss_tolerance=0.1, coin_prefixes=None):
+    # Check which coins need to be modified to not lose to much precision.
+    if coin_prefixes is None:
+        coin_prefixes = select_coin_prefixes(tax_events, precision_loss_tolerance)
 
     # Convert amount to integer
     new_events = []
@@ -196,12 +382,19 @@ def convert_sek_to_integer_amounts(tax_events):
     return new_events
 
 
-def generate_k4_pages(year, personal_details, tax_events, stock_tax_events=None):
-    def generate_section(events):
+def generate_k4_pages(year, personal_details, tax_events, stock_tax_events=None, summary=None):
+    return list(iter_k4_pages(year, personal_details, tax_events, stock_tax_events=stock_tax_events, summary=summary))
+
+
+def iter_k4_pages(year, personal_details, tax_events, stock_tax_events=None, summary=None):
+    """Yield the K4 pages for tax_events one at a time."""
+    def generate_section(events, profits):
         lines = []
         num_sums = [0, 0, 0, 0]
-        for event in events:
-            k4_fields = event.k4_fields()
+        for (event, profit) in zip(events, profits):
+            k4_fields = [event.amount, event.name, event.income, event.cost,
+                         profit if profit > 0 else None,
+                         -profit if profit < 0 else None]
             line = []
             for (field_index, field) in enumerate(k4_fields):
                 if field_index > 3:
@@ -214,30 +407,27 @@ def generate_k4_pages(year, personal_details, tax_events, stock_tax_events=None)
         sums = [str(sum) if sum > 0 else None for sum in num_sums]
         return K4Section(lines, sums)
 
-    fiat_events = [x for x in tax_events if is_fiat(x.name)]
-    crypto_events = [x for x in tax_events if not is_fiat(x.name)]
+    if summary is None:
+        summary = TaxSummary(tax_events, stock_tax_events)
 
-    pages = []
     page_number = 1
     while True:
-        if stock_tax_events:
-            section_a_events = stock_tax_events[(page_number-1)*9:page_number*9]
-        else:
-            section_a_events = []
-        section_c_events = fiat_events[(page_number-1)*7:page_number*7]
-        section_d_events = crypto_events[(page_number-1)*7:page_number*7]
-        if not section_a_events and not section_c_events and not section_d_events:
+        start = (page_number-1)*9
+        section_a = (summary.stock_events[start:start+9], summary.stock_profits[start:start+9])
+        start = (page_number-1)*7
+        section_c = (summary.fiat_events[start:start+7], summary.fiat_profits[start:start+7])
+        section_d = (summary.crypto_events[start:start+7], summary.crypto_profits[start:start+7])
+        if not section_a[0] and not section_c[0] and not section_d[0]:
             break
-        section_a = generate_section(section_a_events)
-        section_c = generate_section(section_c_events)
-        section_d = generate_section(section_d_events)
-        pages.append(K4Page(year, personal_details, page_number,
-                            section_a, section_c, section_d))
+        yield K4Page(year, personal_details, page_number,
+                     generate_section(*section_a), generate_section(*section_c), generate_section(*section_d))
         page_number += 1
-    return pages
 
 
 def generate_k4_sru(pages, personal_details, destination_folder):
+    if not os.path.exists(destination_folder):
+        os.makedirs(destination_folder)
+
     # Generate info.sru
     lines = []
     lines.append("#DATABESKRIVNING_START")
@@ -255,40 +445,51 @@ def generate_k4_sru(pages, personal_details, destination_folder):
     with open(os.path.join(destination_folder, "info.sru"), "w", encoding="iso-8859-1") as f:
         f.write("\n".join(lines))
 
-    # Generate blanketter.sru
-    lines = []
-    for page in pages:
-        lines.extend(page.generate_sru_lines())
-    lines.append("#FIL_SLUT")
-    lines.append("")
+    # Generate blanketter.sru, pages are written as they are produced.
+    now = datetime.now()
+    with open(os.path.join(destination_folder, "blanketter.sru"), "w", encoding="iso-8859-1") as f:
+        for page in pages:
+            for line in page.generate_sru_lines(now):
+                f.write(f"{line}\n")
+        f.write("#FIL_SLUT\n")
+
+
+def generate_k4_pdf(pages, destination_folder, jobs=1, merged=False):
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
-    with open(os.path.join(destination_folder, "blanketter.sru"), "w", encoding="iso-8859-1") as f:
-        f.write("\n".join(lines))
 
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from itertools import repeat
 
-def generate_k4_pdf(pages, destination_folder):
-    for page in pages:
-        page.generate_pdf(destination_folder)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            if merged:
+                overlays = executor.map(K4Page.generate_pdf_overlays, pages, chunksize=8)
+                write_merged_pdf(pages, os.path.join(destination_folder, "k4.pdf"), overlays)
+            else:
+                for _ in executor.map(K4Page.generate_pdf, pages, repeat(destination_folder), chunksize=8):
+                    pass
+    elif merged:
+        write_merged_pdf(pages, os.path.join(destination_folder, "k4.pdf"))
+    else:
+        for page in pages:
+            page.generate_pdf(destination_folder)
 
 
-def output_totals(tax_events, stock_tax_events = None):
-    crypto_tax_events = [x for x in tax_events if not is_fiat(x.name)]
-    fiat_tax_events = [x for x in tax_events if is_fiat(x.name)]
+def output_totals(tax_events, stock_tax_events = None, summary=None):
+    if summary is None:
+        summary = TaxSummary(tax_events, stock_tax_events)
 
-    if stock_tax_events:
-        stock_total_profit = sum([x.profit() if x.profit() > 0 else 0 for x in stock_tax_events])
-        stock_total_loss = sum([-x.profit() if x.profit() < 0 else 0 for x in stock_tax_events])
+    if summary.stock_events:
+        (stock_total_profit, stock_total_loss) = summary.stock_totals
         print("Section A")
         print(f"  Summed profit (box 7.4): {stock_total_profit}")
         print(f"  Summed loss (box 8.3): {stock_total_loss}")
-    fiat_total_profit = sum([x.profit() if x.profit() > 0 else 0 for x in fiat_tax_events])
-    fiat_total_loss = sum([-x.profit() if x.profit() < 0 else 0 for x in fiat_tax_events])
+    (fiat_total_profit, fiat_total_loss) = summary.fiat_totals
     print("Section C")
     print(f"  Summed profit (box 7.2): {fiat_total_profit}")
     print(f"  Summed loss (box 8.1): {fiat_total_loss}")
-    crypto_total_profit = sum([x.profit() if x.profit() > 0 else 0 for x in crypto_tax_events])
-    crypto_total_loss = sum([-x.profit() if x.profit() < 0 else 0 for x in crypto_tax_events])
+    (crypto_total_profit, crypto_total_loss) = summary.crypto_totals
     print("Section D")
     print(f"  Summed profit (box 7.5): {crypto_total_profit}")
     print(f"  Summed loss (box 8.4): {crypto_total_loss}")
@@ -1,7 +1,14 @@
-from datetime import datetime
-import dateutil.parser
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
 import csv
+import itertools
 import json
+import os
+import struct
+from sys import intern
 
 
 class PersonalDetails:
@@ -30,9 +37,13 @@ class Fees:
 
 
 class Trade:
+    __slots__ = ('lineno', 'date', 'type', 'group',
+                 'buy_coin', 'buy_amount', 'buy_value',
+                 'sell_coin', 'sell_amount', 'sell_value', 'source')
+
     def __init__(self, lineno, date:datetime, type, group,
                  buy_coin, buy_amount, buy_value,
-                 sell_coin, sell_amount, sell_value):
+                 sell_coin, sell_amount, sell_value, source=None):
         self.lineno = lineno
         self.date = date
         self.type = type
@@ -43,11 +54,71 @@ class Trade:
         self.sell_coin = sell_coin
         self.sell_amount = sell_amount
         self.sell_value = sell_value
+        # The file the trade was read from when reading several files, lineno is the line in that file.
+        self.source = source
 
 
-def read_usdsek_rates():
+class Rates:
+    """Daily close rates indexed by day ordinal for fast date lookups."""
+
+    def __init__(self, days, closes, pair='USDSEK'):
+        self.days = days
+        self.closes = closes
+        self.pair = pair
+
+    def rate_at(self, wanted_date) -> float:
+        """Return the most recent rate on or before wanted_date."""
+        day = wanted_date.toordinal()
+        if not self.days or day < self.days[0] or day > self.days[-1]:
+            raise Exception("Didn't find a %s conversion rate for date %s" % (self.pair, wanted_date))
+        return self.closes[bisect_right(self.days, day) - 1]
+
+    def rates_at(self, dates):
+        """Return the rate_at() of each of dates as a list.
+
+        The rates are looked up in a single merge pass over the dates in
+        order, dates in chronological or reverse chronological order are not
+        sorted.
+        """
+        days = [date.toordinal() for date in dates]
+        if all(a <= b for (a, b) in zip(days, days[1:])):
+            order = range(len(days))
+        elif all(a >= b for (a, b) in zip(days, days[1:])):
+            order = range(len(days) - 1, -1, -1)
+        else:
+            order = sorted(range(len(days)), key=days.__getitem__)
+
+        rates = [0.0] * len(days)
+        rate_days = self.days
+        closes = self.closes
+        last = len(rate_days) - 1
+        index = 0
+        for i in order:
+            day = days[i]
+            if last < 0 or day < rate_days[0] or day > rate_days[last]:
+                raise Exception("Didn't find a %s conversion rate for date %s" % (self.pair, dates[i]))
+            while index < last and rate_days[index + 1] <= day:
+                index += 1
+            rates[i] = closes[index]
+        return rates
+
+    def digest_before(self, date):
+        """Return the sha1 of the rates before date, which are all the rates used for dates before date."""
+        import hashlib
+
+        end = bisect_right(self.days, (date - timedelta(days=1)).toordinal())
+        sha1 = hashlib.sha1(self.pair.encode("utf-8"))
+        sha1.update(self.days[:end].tobytes())
+        sha1.update(self.closes[:end].tobytes())
+        return sha1.digest()
+
+
+def _parse_rates_csv(filename):
+    # Only needed when the compiled rate cache is rebuilt.
+    import dateutil.parser
+
     rates = []
-    with open('data/rates/usdsek.csv', encoding='utf-8-sig') as f:
+    with open(filename, encoding='utf-8-sig') as f:
         is_first = True
         for row in csv.reader(f, delimiter=',', quotechar='"'):
             if is_first:
@@ -55,82 +126,390 @@ def read_usdsek_rates():
                 continue
             date = dateutil.parser.parse(row[0])
             close = float(row[1])
-            rates.append([date, close])
+            rates.append((date.toordinal(), close))
     rates.sort(key=lambda rate: rate[0])
+    return Rates(array('i', [rate[0] for rate in rates]), array('d', [rate[1] for rate in rates]))
+
+
+# Header of the compiled rate file: magic, mtime and size of the source csv,
+# sha1 of the source csv and the number of (day ordinal, close) pairs.
+_RATE_CACHE_HEADER = struct.Struct('=8sdq20sq')
+_RATE_CACHE_MAGIC = b'CTSRATE1'
+
+
+def _file_sha1(filename):
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+
+_tmp_file_ids = itertools.count()
+
+
+@contextmanager
+def replacing_file(filename, mode='wb', **kwargs):
+    """Open a new temporary file in the folder of filename which replaces filename when closed.
+
+    Every writer gets a file of its own, so concurrent writers never write
+    to the same file and readers see either the old or the complete new file.
+    """
+    while True:
+        tmp_filename = f"{filename}.{os.getpid()}.{next(_tmp_file_ids)}.tmp"
+        try:
+            # Created with the permissions of an ordinary new file, which mkstemp() would restrict.
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            break
+        except FileExistsError:
+            pass
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def _write_rate_cache(cache_filename, rates, stat, digest):
+    with replacing_file(cache_filename) as f:
+        f.write(_RATE_CACHE_HEADER.pack(_RATE_CACHE_MAGIC, stat.st_mtime, stat.st_size, digest, len(rates.days)))
+        rates.days.tofile(f)
+        rates.closes.tofile(f)
+
+
+def _read_rate_cache(cache_filename, stat):
+    """Returns (rates, digest) or (None, None) if there is no usable cache.
+
+    digest is None if mtime and size of the csv-file match the cache, otherwise
+    the stored sha1 digest is returned for the caller to compare against.
+    """
+    try:
+        with open(cache_filename, 'rb') as f:
+            header = f.read(_RATE_CACHE_HEADER.size)
+            (magic, mtime, size, digest, count) = _RATE_CACHE_HEADER.unpack(header)
+            if magic != _RATE_CACHE_MAGIC:
+                return (None, None)
+            days = array('i')
+            days.fromfile(f, count)
+            closes = array('d')
+            closes.fromfile(f, count)
+    except (OSError, EOFError, struct.error):
+        return (None, None)
+    rates = Rates(days, closes)
+    if mtime == stat.st_mtime and size == stat.st_size:
+        return (rates, None)
+    return (rates, digest)
+
+
+def _rates_pair(filename):
+    return os.path.splitext(os.path.basename(filename))[0].upper()
+
+
+def read_rates(filename):
+    """Read daily rates from filename using a compiled cache next to it.
+
+    The cache stores the rates as packed (day ordinal, close) arrays and is
+    rebuilt whenever the csv-file has been modified.
+    """
+    cache_filename = f"{os.path.splitext(filename)[0]}.bin"
+    stat = os.stat(filename)
+    (rates, cached_digest) = _read_rate_cache(cache_filename, stat)
+    if rates is not None and cached_digest is None:
+        rates.pair = _rates_pair(filename)
+        return rates
+
+    digest = _file_sha1(filename)
+    if rates is None or cached_digest != digest:
+        rates = _parse_rates_csv(filename)
+    rates.pair = _rates_pair(filename)
+    try:
+        _write_rate_cache(cache_filename, rates, stat, digest)
+    except OSError:
+        pass
     return rates
 
 
+USDSEK_RATES_FILENAME = 'data/rates/usdsek.csv'
+
+
+def read_usdsek_rates():
+    return read_rates(USDSEK_RATES_FILENAME)
+
+
 def usd_to_sek(rates, wanted_date):
+    return rates.rate_at(wanted_date)
+
+
+def trade_location(lineno, source=None):
+    """Describe where a trade was read from for error messages."""
+    return f"line {lineno} in {source if source else 'trades csv-file'}"
+
+
+def _trade_order(trade):
+    # Trades on the same date are ordered with the last line in the csv-file
+    # first, cointracking lists the most recent trade at the top.
+    return (trade.date, -trade.lineno)
+
+
+def _is_reverse_chronological(trades):
     prev_date = None
-    prev_price = None
-    for rate in rates:
-        date = rate[0]
-        price = rate[1]
-        if prev_date and prev_date <= wanted_date and wanted_date < date:
-            return prev_price
-        prev_date = date
-        prev_price = price
-    raise Exception("Didn't find a USDSEK conversion rate for date %s" % wanted_date)
+    for trade in trades:
+        if prev_date is not None and trade.date > prev_date:
+            return False
+        prev_date = trade.date
+    return True
+
+
+def _sort_run(trades):
+    if _is_reverse_chronological(trades):
+        trades.reverse()
+    else:
+        trades.sort(key=_trade_order)
+    return trades
+
+
+def _spill_run(trades):
+    import pickle
+    import tempfile
+
+    f = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    for trade in trades:
+        pickler.dump(trade)
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    import pickle
+
+    unpickler = pickle.Unpickler(f)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
+MAX_TRADES_IN_MEMORY = 500000
+
+# The number of spilled runs merged at a time, which bounds the number of
+# open temporary files.
+_MAX_MERGED_RUNS = 64
+
+
+def _merge_runs(runs):
+    import heapq
+
+    try:
+        return _spill_run(heapq.merge(*[_read_run(f) for f in runs], key=_trade_order))
+    finally:
+        for f in runs:
+            f.close()
+
+
+def sort_trades(trades, max_trades_in_memory=None):
+    """Yield trades in chronological order.
+
+    Exports from cointracking are in reverse chronological order which is
+    detected and handled by reversing instead of sorting. If more than
+    max_trades_in_memory trades are read, sorted runs are spilled to temporary
+    files and merged, at most _MAX_MERGED_RUNS runs at a time.
+    """
+    # levels[i] holds runs made of up to _MAX_MERGED_RUNS ** i spilled runs.
+    levels = [[]]
+    chunk = []
+    try:
+        for trade in trades:
+            chunk.append(trade)
+            if max_trades_in_memory and len(chunk) >= max_trades_in_memory:
+                levels[0].append(_spill_run(_sort_run(chunk)))
+                chunk = []
+                level = 0
+                while len(levels[level]) == _MAX_MERGED_RUNS:
+                    if level + 1 == len(levels):
+                        levels.append([])
+                    levels[level + 1].append(_merge_runs(levels[level]))
+                    levels[level] = []
+                    level += 1
+        _sort_run(chunk)
+        runs = [f for level_runs in reversed(levels) for f in level_runs]
+        levels = [runs]
+        if not runs:
+            yield from chunk
+            return
+        while len(runs) >= _MAX_MERGED_RUNS:
+            runs[:_MAX_MERGED_RUNS] = [_merge_runs(runs[:_MAX_MERGED_RUNS])]
+        import heapq
+        yield from heapq.merge(*[_read_run(f) for f in runs], chunk, key=_trade_order)
+    finally:
+        for level_runs in levels:
+            for f in level_runs:
+                f.close()
+
+
+def _trade_date(trade):
+    return trade.date
+
+
+def merge_trades(sorted_trades):
+    """Merge a list of iterables of trades in chronological order into one.
+
+    The trades are merged with a k-way merge on the date, without reading
+    them all into memory first. Trades on the same date are taken from the
+    first iterable first.
+    """
+    if len(sorted_trades) == 1:
+        return iter(sorted_trades[0])
+    import heapq
+    return heapq.merge(*sorted_trades, key=_trade_date)
+
+
+@lru_cache(maxsize=4096)
+def parse_trade_date(text) -> datetime:
+    """Parse a cointracking date of the form "dd.mm.YYYY HH:MM".
+
+    Batched fills often share the same minute so results are cached.
+    """
+    if len(text) == 16 and text[2] == '.' and text[5] == '.' and text[10] == ' ' and text[13] == ':':
+        return datetime(int(text[6:10]), int(text[3:5]), int(text[0:2]), int(text[11:13]), int(text[14:16]))
+    return datetime.strptime(text, "%d.%m.%Y %H:%M")
+
+
+def value_currency_of(value_currency):
+    """Return the currency code for a value_currency argument, True and False
+    are accepted for USD and SEK as given by --cointracking-usd."""
+    if value_currency is True:
+        return 'USD'
+    if not value_currency:
+        return 'SEK'
+    return value_currency.upper()
+
+
+def read_trades_csv(filename, value_currency, convert=True, source=None):
+    """Yield trades from a cointracking csv-file in file order.
+
+    The values are read from the "Value in <value_currency>" columns and
+    converted to SEK, unless convert is False in which case
+    fx.FxTable.convert_trades() can be used as a separate pass. source is
+    set on the trades to tell which file they came from.
+    """
+    value_currency = value_currency_of(value_currency)
+    trades = _read_trades_csv(filename, value_currency, source)
+    if value_currency != 'SEK' and convert:
+        import fx
+        return fx.FxTable().convert_trades(trades, value_currency, 'SEK')
+    return trades
+
+
+def convert_trade_values(trades, rates_at, chunk_size=65536):
+    """Yield trades with their values multiplied by the rate at the date of each trade.
+
+    rates_at(dates) returns the rates for a list of dates. The trades are
+    converted a chunk at a time with a single lookup for the dates of the
+    chunk.
+    """
+    chunk = []
+    for trade in trades:
+        chunk.append(trade)
+        if len(chunk) == chunk_size:
+            yield from _convert_chunk(chunk, rates_at)
+            chunk = []
+    if chunk:
+        yield from _convert_chunk(chunk, rates_at)
+
+
+def _convert_chunk(trades, rates_at):
+    rates = rates_at([trade.date for trade in trades])
+    for (trade, rate) in zip(trades, rates):
+        if trade.buy_value:
+            trade.buy_value *= rate
+        if trade.sell_value:
+            trade.sell_value *= rate
+    return trades
+
+
+def trade_columns(header, filename, value_currency):
+    """Return the indices of the columns of a cointracking csv-file header which make up a trade."""
+    def indices(col_name):
+        return [index for index, col in enumerate(header) if col == col_name]
+
+    price_field_name = f'Value in {value_currency}'
+
+    if not indices(price_field_name):
+        raise Exception(f"Trades csv-file {filename} has no values in {value_currency}")
+
+    return (indices('Date')[0], indices('Type')[0], indices('Group')[0],
+            indices('Cur.')[0], indices('Buy')[0], indices(price_field_name)[0],
+            indices('Cur.')[1], indices('Sell')[0], indices(price_field_name)[1])
+
+
+def parse_trade_rows(rows, columns, lineno, source=None):
+    """Yield the trades of rows of a cointracking csv-file, lineno is the line of the first row."""
+    (date_index, type_index, group_index,
+     buy_coin_index, buy_amount_index, buy_value_index,
+     sell_coin_index, sell_amount_index, sell_value_index) = columns
+    for line in rows:
+        try:
+            date = parse_trade_date(line[date_index])
+        except ValueError:
+            raise Exception(f"Invalid date '{line[date_index]}' at {trade_location(lineno, source)}")
+        trade = Trade(
+            lineno,
+            date,
+            intern(line[type_index]),
+            None if line[group_index] == '-' else intern(line[group_index]),
+            None if line[buy_coin_index] == '-' else intern(line[buy_coin_index]),
+            None if line[buy_amount_index] == '-' else float(line[buy_amount_index]),
+            None if line[buy_value_index] == '-' else float(line[buy_value_index]),
+            None if line[sell_coin_index] == '-' else intern(line[sell_coin_index]),
+            None if line[sell_amount_index] == '-' else float(line[sell_amount_index]),
+            None if line[sell_value_index] == '-' else float(line[sell_value_index]),
+            source
+        )
+        yield trade
+        lineno += 1
+
+
+def _read_trades_csv(filename, value_currency, source):
+    with open(filename, encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter=',', quotechar='"')
+        header = next(reader, None)
+        if header is None:
+            raise Exception(f"Trades csv-file {filename} is empty")
+        yield from parse_trade_rows(reader, trade_columns(header, filename, value_currency), 2, source)
 
 
 class Trades:
     def __init__(self, trades):
         self.trades = trades
 
-    @staticmethod
-    def read_from(filename, value_in_usd):
-        with open(filename, encoding='utf-8-sig') as f:
-            lines = [line for line in csv.reader(f, delimiter=',', quotechar='"')]
-
-        if value_in_usd:
-            usdsek = read_usdsek_rates()
-
-        def indices(col_name):
-            return [index for index, col in enumerate(lines[0]) if col == col_name]
-
-        price_field_name = 'Value in USD' if value_in_usd else 'Value in SEK'
-
-        date_index = indices('Date')[0]
-        type_index = indices('Type')[0]
-        group_index = indices('Group')[0]
-        buy_coin_index = indices('Cur.')[0]
-        buy_amount_index = indices('Buy')[0]
-        buy_value_index = indices(price_field_name)[0]
-        sell_coin_index = indices('Cur.')[1]
-        sell_amount_index = indices('Sell')[0]
-        sell_value_index = indices(price_field_name)[1]
-
-        trades = []
-        lineno = 2
-        for line in lines[1:]:
-            trade = Trade(
-                lineno,
-                datetime.strptime(line[date_index], "%d.%m.%Y %H:%M"),
-                line[type_index],
-                None if line[group_index] == '-' else line[group_index],
-                None if line[buy_coin_index] == '-' else line[buy_coin_index],
-                None if line[buy_amount_index] == '-' else float(line[buy_amount_index]),
-                None if line[buy_value_index] == '-' else float(line[buy_value_index]),
-                None if line[sell_coin_index] == '-' else line[sell_coin_index],
-                None if line[sell_amount_index] == '-' else float(line[sell_amount_index]),
-                None if line[sell_value_index] == '-' else float(line[sell_value_index])
-            )
-            if value_in_usd:
-                usdsek_rate = usd_to_sek(usdsek, trade.date)
-                if trade.buy_value:
-                    trade.buy_value *= usdsek_rate
-                if trade.sell_value:
-                    trade.sell_value *= usdsek_rate
-            trades.append(trade)
-            lineno += 1
+    def __iter__(self):
+        return iter(self.trades)
 
-        trades.reverse()
-        trades.sort(key=lambda x: x.date)
+    @staticmethod
+    def read_from(filename, value_currency, cache_filename=None):
+        """Read the trades of filename in chronological order.
 
-        return Trades(trades)
+        With cache_filename the parsed trades are stored in it and later
+        calls only parse the rows added to filename since, see tradecache.py.
+        """
+        if cache_filename is None:
+            return Trades(list(sort_trades(read_trades_csv(filename, value_currency))))
+        import tradecache
+        return Trades(list(sort_trades(tradecache.read_trades(filename, value_currency, cache_filename=cache_filename))))
 
 
 class TaxEvent:
+    __slots__ = ('amount', 'name', 'income', 'cost')
+
     def __init__(self, amount, name:str, income, cost):
         self.amount = amount
         self.name = name
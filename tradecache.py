@@ -0,0 +1,299 @@
+"""Incremental parsing of a growing cointracking csv-file.
+
+The parsed trades of a csv-file are stored as columns in a binary file next
+to it, together with the sha1 of the rows they were parsed from. Cointracking
+lists the most recent trades first, so a new export of the same history has
+the new rows inserted right after the header. When the stored rows are found
+unchanged after the new rows, or before them if rows were appended at the
+end, only the new rows are parsed. Otherwise the whole file is parsed again.
+"""
+from array import array
+from datetime import datetime, timedelta
+import csv
+import hashlib
+import io
+import itertools
+import operator
+import os
+import struct
+
+from taxdata import Trade, parse_trade_rows, read_trades_csv, replacing_file, trade_columns, value_currency_of
+
+
+# Magic, mtime and size of the csv-file, sha1 of the header and value
+# currency, sha1 of the rows, number of names and number of rows. The names
+# are stored as lengths and utf-8 data, followed by the columns.
+_HEADER = struct.Struct('=8sdq20s20sqq')
+_MAGIC = b'CTSTRD01'
+
+_EPOCH = datetime(1970, 1, 1)
+_MINUTE = timedelta(minutes=1)
+
+
+def _read_array(f, typecode, count):
+    a = array(typecode)
+    a.fromfile(f, count)
+    return a
+
+
+class TradeColumns:
+    """The trades of the rows of a csv-file as columns.
+
+    Dates are minutes since 1970, strings are indices into names or -1 for
+    None and missing amounts and values are nan.
+    """
+
+    def __init__(self, names=None, name_indices=None):
+        self.names = names if names is not None else []
+        self._name_indices = name_indices if name_indices is not None else {name: index for (index, name) in enumerate(self.names)}
+        self.dates = array('q')
+        self.types = array('i')
+        self.groups = array('i')
+        self.buy_coins = array('i')
+        self.buy_amounts = array('d')
+        self.buy_values = array('d')
+        self.sell_coins = array('i')
+        self.sell_amounts = array('d')
+        self.sell_values = array('d')
+        self._descending = None
+
+    def _columns(self):
+        return [self.dates, self.types, self.groups, self.buy_coins, self.buy_amounts, self.buy_values,
+                self.sell_coins, self.sell_amounts, self.sell_values]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _name_index(self, name):
+        if name is None:
+            return -1
+        index = self._name_indices.get(name)
+        if index is None:
+            index = self._name_indices[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def sharing_names(self):
+        """Return empty columns using the same names, for rows to be joined with these."""
+        return TradeColumns(self.names, self._name_indices)
+
+    def append(self, trade):
+        nan = float('nan')
+        self.dates.append((trade.date - _EPOCH) // _MINUTE)
+        self.types.append(self._name_index(trade.type))
+        self.groups.append(self._name_index(trade.group))
+        self.buy_coins.append(self._name_index(trade.buy_coin))
+        self.buy_amounts.append(nan if trade.buy_amount is None else trade.buy_amount)
+        self.buy_values.append(nan if trade.buy_value is None else trade.buy_value)
+        self.sell_coins.append(self._name_index(trade.sell_coin))
+        self.sell_amounts.append(nan if trade.sell_amount is None else trade.sell_amount)
+        self.sell_values.append(nan if trade.sell_value is None else trade.sell_value)
+
+    def joined(self, other):
+        """Return the rows of self followed by the rows of other, which must share the names of self."""
+        joined = self.sharing_names()
+        for (column, first, second) in zip(joined._columns(), self._columns(), other._columns()):
+            column.extend(first)
+            column.extend(second)
+        return joined
+
+    def trades(self, source=None):
+        """Yield the trades in file order."""
+        # Index -1 gives None.
+        names = self.names + [None]
+        dates = {}
+        lineno = 2
+        for (date, type, group, buy_coin, buy_amount, buy_value, sell_coin, sell_amount, sell_value) in zip(*self._columns()):
+            trade_date = dates.get(date)
+            if trade_date is None:
+                trade_date = dates[date] = _EPOCH + date * _MINUTE
+            yield Trade(lineno, trade_date, names[type], names[group],
+                        names[buy_coin], None if buy_amount != buy_amount else buy_amount,
+                        None if buy_value != buy_value else buy_value,
+                        names[sell_coin], None if sell_amount != sell_amount else sell_amount,
+                        None if sell_value != sell_value else sell_value,
+                        source)
+            lineno += 1
+
+    def digest_before(self, date):
+        """Return the sha1 of the rows dated before date or None if they are not the last rows.
+
+        Rows in the reverse chronological order of cointracking have the rows
+        before a date at the end, those are hashed a column at a time.
+        """
+        dates = self.dates
+        if self._descending is None:
+            self._descending = all(map(operator.ge, dates, itertools.islice(dates, 1, None)))
+        if not self._descending:
+            return None
+        minutes = (date - _EPOCH) // _MINUTE
+        # Binary search for the first row before date.
+        (low, high) = (0, len(dates))
+        while low < high:
+            middle = (low + high) // 2
+            if dates[middle] < minutes:
+                high = middle
+            else:
+                low = middle + 1
+        sha1 = hashlib.sha1()
+        for column in self._columns():
+            sha1.update(column[low:].tobytes())
+        # Names are only added at the end, so the names used by the rows are
+        # a prefix of the names which does not change when rows are added.
+        used_names = max([max(column[low:], default=-1) for column in [self.types, self.groups, self.buy_coins, self.sell_coins]])
+        for name in self.names[:used_names + 1]:
+            sha1.update(name.encode("utf-8") + b'\0')
+        return sha1.digest()
+
+    def write(self, f):
+        encoded_names = [name.encode("utf-8") for name in self.names]
+        array('q', [len(name) for name in encoded_names]).tofile(f)
+        for name in encoded_names:
+            f.write(name)
+        for column in self._columns():
+            column.tofile(f)
+
+    @staticmethod
+    def read(f, name_count, row_count):
+        names = [f.read(length).decode("utf-8") for length in _read_array(f, 'q', name_count)]
+        columns = TradeColumns(names)
+        for column in columns._columns():
+            column.fromfile(f, row_count)
+        return columns
+
+
+class _CachedRows:
+    def __init__(self, mtime, size, rows_digest, columns):
+        self.mtime = mtime
+        self.size = size
+        self.rows_digest = rows_digest
+        self.columns = columns
+
+
+def cache_filename_of(filename):
+    return f"{os.path.splitext(filename)[0]}.bin"
+
+
+def _read_cache(cache_filename, header_digest):
+    try:
+        with open(cache_filename, 'rb') as f:
+            (magic, mtime, size, cached_header_digest, rows_digest, name_count, row_count) = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or cached_header_digest != header_digest:
+                return None
+            return _CachedRows(mtime, size, rows_digest, TradeColumns.read(f, name_count, row_count))
+    except (OSError, EOFError, UnicodeDecodeError, struct.error):
+        return None
+
+
+def _write_cache(cache_filename, stat, header_digest, rows_digest, columns):
+    with replacing_file(cache_filename) as f:
+        f.write(_HEADER.pack(_MAGIC, stat.st_mtime, stat.st_size, header_digest, rows_digest, len(columns.names), len(columns)))
+        columns.write(f)
+
+
+def _update_range(f, start, length, hashes):
+    f.seek(start)
+    while length > 0:
+        chunk = f.read(min(length, 1 << 16))
+        if not chunk:
+            break
+        for h in hashes:
+            h.update(chunk)
+        length -= len(chunk)
+
+
+def _parse_new_rows(f, cached, rows_offset, size, header, filename, value_currency, source):
+    """Return (columns, rows_digest) with the rows added to the cached rows or None if other rows have changed."""
+    added = size - cached.size
+    if added < 0:
+        return None
+    covered = cached.size - rows_offset
+    # New rows inserted after the header, as by cointracking, or appended at the end.
+    placements = [(rows_offset + added, rows_offset, True)]
+    if added > 0:
+        placements.append((rows_offset, rows_offset + covered, False))
+    for (covered_start, new_start, prepended) in placements:
+        if added > 0 and covered > 0:
+            # The rows must still begin on a line of their own.
+            f.seek(max(covered_start, new_start) - 1)
+            if f.read(1) != b'\n':
+                continue
+        f.seek(new_start)
+        new_rows = f.read(added)
+        rows_hash = hashlib.sha1()
+        cached_rows_hash = hashlib.sha1()
+        if prepended:
+            rows_hash.update(new_rows)
+        _update_range(f, covered_start, covered, [rows_hash, cached_rows_hash])
+        if not prepended:
+            rows_hash.update(new_rows)
+        if cached_rows_hash.digest() != cached.rows_digest:
+            continue
+
+        columns = cached.columns.sharing_names()
+        rows = csv.reader(io.StringIO(new_rows.decode('utf-8'), newline=''), delimiter=',', quotechar='"')
+        lineno = 2 if prepended else 2 + len(cached.columns)
+        for trade in parse_trade_rows(rows, trade_columns(header, filename, value_currency), lineno, source):
+            columns.append(trade)
+        if prepended:
+            return (columns.joined(cached.columns), rows_hash.digest())
+        return (cached.columns.joined(columns), rows_hash.digest())
+    return None
+
+
+def read_columns(filename, value_currency, source=None, cache_filename=None):
+    """Return the TradeColumns of a cointracking csv-file with the values in value_currency.
+
+    Only the rows added since the previous call are parsed, the trades are
+    stored in cache_filename, by default next to the csv-file.
+    """
+    if cache_filename is None:
+        cache_filename = cache_filename_of(filename)
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        header_line = f.readline()
+        header_digest = hashlib.sha1(value_currency.encode("utf-8") + b'\n' + header_line).digest()
+        rows_offset = len(header_line)
+        cached = _read_cache(cache_filename, header_digest) if header_line else None
+        updated = None
+        if cached is not None and cached.mtime == stat.st_mtime and cached.size == stat.st_size:
+            columns = cached.columns
+        else:
+            if cached is not None:
+                header = next(csv.reader([header_line.decode('utf-8-sig')], delimiter=',', quotechar='"'))
+                updated = _parse_new_rows(f, cached, rows_offset, stat.st_size, header, filename, value_currency, source)
+            if updated is None:
+                columns = TradeColumns()
+                for trade in read_trades_csv(filename, value_currency, convert=False, source=source):
+                    columns.append(trade)
+                rows_hash = hashlib.sha1()
+                _update_range(f, rows_offset, stat.st_size - rows_offset, [rows_hash])
+                updated = (columns, rows_hash.digest())
+            columns = updated[0]
+
+    if updated is not None:
+        try:
+            _write_cache(cache_filename, stat, header_digest, updated[1], columns)
+        except OSError:
+            pass
+
+    return columns
+
+
+def read_trades(filename, value_currency, convert=True, source=None, cache_filename=None):
+    """Yield trades from a cointracking csv-file in file order, like taxdata.read_trades_csv().
+
+    Only the rows added since the previous call are parsed, see read_columns().
+    """
+    value_currency = value_currency_of(value_currency)
+    return trades_of(read_columns(filename, value_currency, source, cache_filename), value_currency, convert, source)
+
+
+def trades_of(columns, value_currency, convert=True, source=None):
+    """Yield the trades of columns in file order with the values converted from value_currency to SEK unless convert is False."""
+    value_currency = value_currency_of(value_currency)
+    trades = columns.trades(source)
+    if value_currency != 'SEK' and convert:
+        import fx
+        return fx.FxTable().convert_trades(trades, value_currency, 'SEK')
+    return trades
@@ -0,0 +1,69 @@
+"""Compare the tax of a year when different cointracking groups are excluded.
+
+    python whatif.py 2019 --exclude-groups airdrop --exclude-groups airdrop bot
+
+prints the section C and D totals for the trades without exclusions and for
+each set of excluded groups. Without --exclude-groups the sets are read from
+standard input, one line of space separated groups at a time, so that
+exclusions can be tried interactively. Only the coins traded in the excluded
+groups are computed again for each set.
+"""
+import argparse
+import datetime
+import sys
+
+import costbasis
+import report
+import tax
+
+
+def print_totals(exclude_groups, tax_events):
+    label = " ".join(exclude_groups) if exclude_groups else "(none)"
+    if tax_events is None:
+        print(f"{label[:29].ljust(30)}failed")
+        return
+    summary = tax.TaxSummary(tax.convert_sek_to_integer_amounts(tax_events))
+    (fiat_total_profit, fiat_total_loss) = summary.fiat_totals
+    (crypto_total_profit, crypto_total_loss) = summary.crypto_totals
+    crypto_tax = round(0.3 * (crypto_total_profit - 0.7 * crypto_total_loss))
+    print(f"{label[:29].ljust(30)}{fiat_total_profit:>12}{fiat_total_loss:>12}{crypto_total_profit:>12}"
+          f"{crypto_total_loss:>12}{crypto_tax:>12}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the tax of a year with different cointracking groups excluded')
+    parser.add_argument('year', type=int, help='Tax year to compare')
+    parser.add_argument('--trades', nargs='+', help='Read trades from csv, parquet or arrow files', default=['data/trades.csv'])
+    parser.add_argument('--exclude-groups', nargs='*', action='append', help='A set of cointracking groups to exclude, can be given several times')
+    parser.add_argument('--cointracking-usd', help='Use this flag if you have configured cointracking calculate prices in USD.', action='store_true')
+    parser.add_argument('--cointracking-currency', type=report.currency_code, help='The currency cointracking has been configured to calculate prices in.', default='SEK')
+    parser.add_argument('--no-cache', help='Always parse the trades instead of reusing the trades parsed by an earlier run', action='store_true')
+    parser.add_argument('--max-overdraft', type=float, help='The maximum overdraft to allow for each coin.', default=1e-9)
+    opts = parser.parse_args(argv)
+
+    try:
+        table = costbasis.TradeTable.from_trades(report.read_trades(opts))
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    analysis = costbasis.ExcludeGroupsAnalysis(table,
+                                               datetime.datetime(year=opts.year, month=1, day=1, hour=0, minute=0),
+                                               datetime.datetime(year=opts.year, month=12, day=31, hour=23, minute=59),
+                                               opts.max_overdraft)
+
+    print(f"{'Excluded groups'.ljust(30)}{'C profit'.rjust(12)}{'C loss'.rjust(12)}{'D profit'.rjust(12)}"
+          f"{'D loss'.rjust(12)}{'D tax'.rjust(12)}")
+    print_totals([], analysis.compute_tax())
+    if opts.exclude_groups:
+        for exclude_groups in opts.exclude_groups:
+            print_totals(exclude_groups, analysis.compute_tax(exclude_groups))
+    else:
+        for line in sys.stdin:
+            exclude_groups = line.split()
+            if exclude_groups:
+                print_totals(exclude_groups, analysis.compute_tax(exclude_groups))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()